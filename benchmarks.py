@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__description__ = """Benchmarks on a synthetic repository farm"""
+__license__ = 'GPLv3'
+
+# Build a reproducible farm of local git repositories, without network
+# access, then time the repository search, the remote update and the checks,
+# through the command line and through gitcheck(). Results are written as
+# JSON so runs can be compared:
+#
+#     python benchmarks.py --repos 200 --output before.json
+#     python benchmarks.py --repos 200 --output after.json --compare before.json
+#
+# Unknown options are passed to gitcheck, e.g. 'python benchmarks.py -- -a'
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from contextlib import redirect_stdout
+from concurrent.futures import wait
+
+from gitcheck import gitcheck
+
+GITCHECK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gitcheck', 'gitcheck.py')
+
+# Fixed identity and dates so the farm is the same on every run
+GITENV = dict(
+    os.environ,
+    GIT_AUTHOR_NAME='bench',
+    GIT_AUTHOR_EMAIL='bench@localhost',
+    GIT_AUTHOR_DATE='2015-05-05T00:00:00+0000',
+    GIT_COMMITTER_NAME='bench',
+    GIT_COMMITTER_EMAIL='bench@localhost',
+    GIT_COMMITTER_DATE='2015-05-05T00:00:00+0000',
+    GIT_CONFIG_NOSYSTEM='1',
+    GIT_CONFIG_GLOBAL=os.devnull,
+)
+
+
+def git(cwd, *args):
+    subprocess.check_call(['git', '-C', cwd] + list(args),
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=GITENV)
+
+
+def commit(work, filename, content, message):
+    with open(os.path.join(work, filename), 'a') as fh:
+        fh.write(content)
+    git(work, 'add', filename)
+    git(work, 'commit', '-q', '-m', message)
+
+
+# Build one repository, its branches and its remotes backed by local bare
+# repositories, with the requested local changes and ahead/behind distances
+def buildRepository(work, remotedir, name, params, rng):
+    os.makedirs(work)
+    git(work, 'init', '-q', '-b', 'master')
+    for idx in range(params.files):
+        commit(work, 'file-%d' % idx, 'base\n', 'Add file-%d' % idx)
+    for idx in range(params.branches):
+        git(work, 'branch', 'branch-%d' % idx)
+
+    for idx in range(params.remotes):
+        bare = os.path.join(remotedir, '%s-%d.git' % (name, idx))
+        git(remotedir, 'init', '-q', '--bare', bare)
+        git(work, 'remote', 'add', 'remote-%d' % idx, 'file://%s' % bare)
+        git(work, 'push', '-q', 'remote-%d' % idx, '--all')
+    if params.remotes:
+        git(work, 'branch', '-q', '-u', 'remote-0/master')
+
+        behind = rng.randint(0, params.behind)
+        if behind:
+            for idx in range(behind):
+                commit(work, 'file-0', 'behind %d\n' % idx, 'Behind %d' % idx)
+            git(work, 'push', '-q', 'remote-0', 'master')
+            git(work, 'reset', '-q', '--hard', 'HEAD~%d' % behind)
+
+    for idx in range(rng.randint(0, params.ahead)):
+        commit(work, 'file-0', 'ahead %d\n' % idx, 'Ahead %d' % idx)
+
+    if rng.random() < params.dirty:
+        with open(os.path.join(work, 'file-0'), 'a') as fh:
+            fh.write('dirty\n')
+    if rng.random() < params.untracked:
+        for idx in range(params.files):
+            with open(os.path.join(work, 'untracked-%d' % idx), 'w') as fh:
+                fh.write('untracked\n')
+
+
+# Build the farm below farmdir/tree, remotes live in farmdir/remotes
+def buildFarm(farmdir, params):
+    rng = random.Random(params.seed)
+    tree = os.path.join(farmdir, 'tree')
+    remotedir = os.path.join(farmdir, 'remotes')
+    os.makedirs(remotedir)
+    for idx in range(params.repos):
+        levels = ['level%d-%d' % (level, rng.randrange(params.fanout)) for level in range(params.depth)]
+        name = 'repo-%d' % idx
+        buildRepository(os.path.join(tree, *(levels + [name])), remotedir, name, params, rng)
+    return tree
+
+
+def timeRuns(runs, fn):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        'runs': times,
+        'min': min(times),
+        'median': statistics.median(times),
+    }
+
+
+def fetchAll(repo):
+    fetcher = gitcheck.FetchScheduler(gitcheck.opts)
+    for r in repo:
+        fetcher.schedule(r)
+    wait([f for r in repo for f in fetcher.repos[r]])
+    fetcher.shutdown()
+
+
+# Git backends of gitcheck usable here, pygit2 is optional
+def getBackends():
+    backends = ['subprocess']
+    try:
+        import pygit2
+        backends.append('pygit2')
+    except ImportError:
+        pass
+    return backends
+
+
+def runBenchmarks(tree, params, gitcheckargs):
+    devnull = open(os.devnull, 'w')
+    gitcheck.opts = gitcheck.parseArgs(gitcheckargs + [tree])
+    gitcheck.disableColors()
+
+    def search(rescan):
+        gitcheck.opts.rescan = rescan
+        return gitcheck.searchRepositories([tree])
+
+    repo = search(True)
+    phases = {}
+    phases['discovery-cold'] = timeRuns(params.runs, lambda: search(True))
+    phases['discovery-cached'] = timeRuns(params.runs, lambda: search(False))
+    phases['remote-update'] = timeRuns(params.runs, lambda: fetchAll(repo))
+    phases['check'] = timeRuns(params.runs, lambda: list(gitcheck.checkRepositories(repo, gitcheck.opts, [tree])))
+
+    # Same checks with the other backends
+    backend = gitcheck.opts.backend
+    for other in getBackends():
+        if other != backend:
+            gitcheck.opts.backend = other
+            phases['check --backend %s' % other] = timeRuns(
+                params.runs, lambda: list(gitcheck.checkRepositories(repo, gitcheck.opts, [tree])))
+    gitcheck.opts.backend = backend
+
+    def inprocess():
+        with redirect_stdout(devnull):
+            gitcheck.gitcheck([tree])
+    phases['gitcheck()'] = timeRuns(params.runs, inprocess)
+
+    cli = [sys.executable, GITCHECK, '--no-color'] + gitcheckargs + [tree]
+    phases['cli'] = timeRuns(params.runs, lambda: subprocess.check_call(cli, stdout=devnull))
+    phases['cli --remote'] = timeRuns(params.runs, lambda: subprocess.check_call(cli + ['-r'], stdout=devnull))
+    for other in getBackends():
+        if other != backend:
+            phases['cli --backend %s' % other] = timeRuns(
+                params.runs, lambda: subprocess.check_call(cli + ['--backend', other], stdout=devnull))
+
+    devnull.close()
+    return len(repo), phases
+
+
+def getEnvironment():
+    gitversion = subprocess.check_output(['git', '--version']).decode('utf-8').strip()
+    try:
+        revision = subprocess.check_output(['git', '-C', os.path.dirname(GITCHECK), 'rev-parse', 'HEAD'],
+                                           stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except subprocess.CalledProcessError:
+        revision = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'backends': getBackends(),
+        'cpus': os.cpu_count(),
+        'git': gitversion,
+        'revision': revision,
+    }
+
+
+def showComparison(previous, current):
+    print("%-24s %12s %12s %8s" % ('phase', 'previous', 'current', 'ratio'))
+    for name, phase in current['phases'].items():
+        before = previous['phases'].get(name)
+        if before is None:
+            print("%-24s %12s %11.3fs" % (name, '-', phase['median']))
+            continue
+        print("%-24s %11.3fs %11.3fs %7.2fx" % (
+            name, before['median'], phase['median'], phase['median'] / before['median']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gitcheck on a synthetic repository farm.')
+    parser.add_argument('--repos', type=int, default=50, help='Number of repositories (default: 50)')
+    parser.add_argument('--depth', type=int, default=2, help='Directory levels above repositories (default: 2)')
+    parser.add_argument('--fanout', type=int, default=3, help='Directories per level (default: 3)')
+    parser.add_argument('--files', type=int, default=3, help='Files per repository (default: 3)')
+    parser.add_argument('--branches', type=int, default=3, help='Extra branches per repository (default: 3)')
+    parser.add_argument('--remotes', type=int, default=1, help='Remotes per repository (default: 1)')
+    parser.add_argument('--ahead', type=int, default=3, help='Maximum commits to push (default: 3)')
+    parser.add_argument('--behind', type=int, default=3, help='Maximum commits to pull (default: 3)')
+    parser.add_argument('--dirty', type=float, default=0.3, help='Ratio of repositories with changes (default: 0.3)')
+    parser.add_argument('--untracked', type=float, default=0.3,
+                        help='Ratio of repositories with untracked files (default: 0.3)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the farm (default: 0)')
+    parser.add_argument('--runs', type=int, default=3, help='Runs of each phase (default: 3)')
+    parser.add_argument('--farm', help='Farm directory, reused if it exists (default: a temporary directory)')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--compare', help='Compare with the JSON results of a previous run')
+    params, gitcheckargs = parser.parse_known_args()
+    gitcheckargs = [a for a in gitcheckargs if a != '--']
+
+    farmdir = params.farm or tempfile.mkdtemp(prefix='gitcheck-bench-')
+    # Keep the gitcheck caches of the benchmark away from the user ones
+    os.environ['XDG_CACHE_HOME'] = os.path.join(farmdir, 'cache')
+    tree = os.path.join(farmdir, 'tree')
+    try:
+        if not os.path.isdir(tree):
+            start = time.perf_counter()
+            buildFarm(farmdir, params)
+            print("Built %s repositories in %.1fs" % (params.repos, time.perf_counter() - start), file=sys.stderr)
+
+        nbrepos, phases = runBenchmarks(tree, params, gitcheckargs)
+    finally:
+        if not params.farm:
+            shutil.rmtree(farmdir)
+
+    results = {
+        'timestamp': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'params': vars(params),
+        'gitcheck_args': gitcheckargs,
+        'repositories': nbrepos,
+        'environment': getEnvironment(),
+        'phases': phases,
+    }
+    for name, phase in phases.items():
+        print("%-24s min %8.3fs  median %8.3fs" % (name, phase['min'], phase['median']))
+    if params.output:
+        with open(params.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    if params.compare:
+        with open(params.compare) as fh:
+            showComparison(json.load(fh), results)
+
+
+if __name__ == "__main__":
+    main()
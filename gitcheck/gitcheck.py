@@ -5,64 +5,296 @@ from __future__ import unicode_literals, absolute_import, division, print_functi
 
 import os
 import re
+import fnmatch
+import hashlib
 import sys
 
 import argparse
 import time
 import subprocess
+import threading
+import heapq
+import signal
+from collections import Counter, deque
+from itertools import chain
 from subprocess import PIPE
-import smtplib
-from smtplib import SMTPException
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 import shlex
 
 from os.path import expanduser
 from time import strftime
 
-import json
+from contextlib import contextmanager
 
-from colored import fg, bg, attr
-
-# Global vars
+# Global vars, the color theme is built on first use by getColorTheme(),
+# json, colored, concurrent.futures and the mail modules are imported only
+# where they are used to keep the startup fast
 colortheme = None
-#Load custom parameters from ~/mygitcheck.py
-configfile = expanduser('~/mygitcheck.py')
-if os.path.exists(configfile):
-    sys.path.append(expanduser('~'))
-    import mygitcheck as userconf
-
-    # Try to load colortheme
-    if hasattr(userconf, 'colortheme'):
-        colortheme = userconf.colortheme
-if colortheme is None:
-    # Default theme
-    defaultcolor = attr('reset') + fg('white')
-    colortheme = {
-        'default': defaultcolor,
-        'prjchanged': attr('reset') + attr('bold') + fg('deep_pink_1a'),
-        'prjremote': attr('reverse') + fg('light_cyan'),
-        'prjname': attr('reset') + fg('chartreuse_1'),
-        'reponame': attr('reset') + fg('light_goldenrod_2b'),
-        'branchname': defaultcolor,
-        'fileupdated': attr('reset') + fg('light_goldenrod_2b'),
-        'remoteto': attr('reset') + fg('deep_sky_blue_3b'),
-        'committo': attr('reset') + fg('violet'),
-        'commitinfo': attr('reset') + fg('deep_sky_blue_3b'),
-        'commitstate': attr('reset') + fg('deep_pink_1a'),
-        'bell': "\a",
-        'reset': "\033[2J\033[H"
-    }
+userconf = None
 
 
-class html:
-    msg = "<ul>\n"
-    topull = ""
-    topush = ""
-    strlocal = ""
-    prjname = ""
-    path = ""
-    timestamp = ""
+#Load custom parameters from ~/mygitcheck.py
+def loadUserConfig():
+    global userconf, colortheme
+    configfile = expanduser('~/mygitcheck.py')
+    if userconf is None and os.path.exists(configfile):
+        sys.path.append(expanduser('~'))
+        import mygitcheck as userconf
+
+        # Try to load colortheme
+        if colortheme is None and hasattr(userconf, 'colortheme'):
+            colortheme = userconf.colortheme
+
+
+def getColorTheme():
+    global colortheme
+    if colortheme is None:
+        from colored import fg, attr
+
+        # Default theme
+        defaultcolor = attr('reset') + fg('white')
+        colortheme = {
+            'default': defaultcolor,
+            'prjchanged': attr('reset') + attr('bold') + fg('deep_pink_1a'),
+            'prjremote': attr('reverse') + fg('light_cyan'),
+            'prjname': attr('reset') + fg('chartreuse_1'),
+            'reponame': attr('reset') + fg('light_goldenrod_2b'),
+            'branchname': defaultcolor,
+            'fileupdated': attr('reset') + fg('light_goldenrod_2b'),
+            'remoteto': attr('reset') + fg('deep_sky_blue_3b'),
+            'committo': attr('reset') + fg('violet'),
+            'commitinfo': attr('reset') + fg('deep_sky_blue_3b'),
+            'commitstate': attr('reset') + fg('deep_pink_1a'),
+            'bell': "\a",
+            'reset': "\033[2J\033[H"
+        }
+    return colortheme
+
+
+# Theme of --no-color, without building the colored one
+def disableColors():
+    global colortheme
+    colortheme = dict.fromkeys(['default', 'prjchanged', 'prjremote', 'prjname', 'reponame', 'branchname',
+                                'fileupdated', 'remoteto', 'committo', 'commitinfo', 'commitstate',
+                                'bell', 'reset'], '')
+
+
+# Number of git subprocesses spawned and check durations, by repository
+class gitstats:
+    lock = threading.Lock()
+    commands = Counter()
+    durations = {}
+
+
+# Timed events of a run recorded with --profile, times are in seconds
+# relative to profiler.origin
+class profiler:
+    lock = threading.Lock()
+    origin = time.time()
+    events = []
+
+
+# Record an event of category cat (command, phase, repository, render)
+def profileEvent(cat, name, start, duration, **args):
+    if not opts.profile:
+        return
+    with profiler.lock:
+        profiler.events.append({
+            'cat': cat,
+            'name': name,
+            'start': start - profiler.origin,
+            'duration': duration,
+            'tid': threading.current_thread().ident,
+            'args': args,
+        })
+
+
+# Time a phase of the run
+@contextmanager
+def profilePhase(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        profileEvent('phase', name, start, time.time() - start)
+
+
+# Print the phases and the top-N slowest repositories and git commands
+def showProfile():
+    events = profiler.events
+    top = opts.profileTop
+    print("Profile:", file=sys.stderr)
+    for e in events:
+        if e['cat'] == 'phase':
+            print("  %-10s %9.3fs" % (e['name'], e['duration']), file=sys.stderr)
+
+    commands = [e for e in events if e['cat'] == 'command']
+    cmdtime = Counter()
+    cmdcount = Counter()
+    for e in commands:
+        cmdtime[e['args']['repository']] += e['duration']
+        cmdcount[e['args']['repository']] += 1
+    repos = sorted((e for e in events if e['cat'] == 'repository'), key=lambda e: -e['duration'])
+    print("Slowest repositories:", file=sys.stderr)
+    for e in repos[:top]:
+        print("  %9.3fs %4d git commands (%.3fs) %s" % (
+            e['duration'], cmdcount[e['name']], cmdtime[e['name']], e['name']), file=sys.stderr)
+
+    print("Slowest git commands:", file=sys.stderr)
+    for e in sorted(commands, key=lambda e: -e['duration'])[:top]:
+        print("  %9.3fs exit %s %8d bytes  %s: git %s" % (
+            e['duration'], e['args']['returncode'], e['args']['size'], e['args']['repository'], e['name']),
+            file=sys.stderr)
+
+
+# Write the events in the Chrome trace event format, readable with
+# chrome://tracing or https://ui.perfetto.dev
+def writeTrace(filename):
+    import json
+    trace = []
+    for e in profiler.events:
+        trace.append({
+            'name': e['name'],
+            'cat': e['cat'],
+            'ph': 'X',
+            'ts': int(e['start'] * 1e6),
+            'dur': int(e['duration'] * 1e6),
+            'pid': os.getpid(),
+            'tid': e['tid'],
+            'args': e['args'],
+        })
+    with open(filename, 'w') as fh:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, fh)
+    showDebug("Trace written to %s" % filename)
+
+
+# Results of one gitcheck run, created fresh for every run
+class Report:
+    __slots__ = ('path', 'timestamp', 'repositories')
+
+    def __init__(self, path):
+        self.path = path
+        self.timestamp = ""
+        self.repositories = []
+
+    @property
+    def actionNeeded(self):
+        return any(r.actionNeeded for r in self.repositories)
+
+    def toDict(self):
+        return {
+            'path': self.path,
+            'timestamp': self.timestamp,
+            'actionNeeded': self.actionNeeded,
+            'repositories': [r.toDict() for r in self.repositories],
+        }
+
+    @classmethod
+    def fromDict(cls, content):
+        report = cls(content['path'])
+        report.timestamp = content['timestamp']
+        report.repositories = [RepoResult.fromDict(r) for r in content['repositories']]
+        return report
+
+
+# Result of a repository check, timedout when a git command ran out of
+# --timeout or --deadline, branches are then unknown
+class RepoResult:
+    __slots__ = ('path', 'name', 'branches', 'timedout')
+
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self.branches = []
+        self.timedout = False
+
+    @property
+    def actionNeeded(self):
+        return any(b.actionNeeded for b in self.branches)
+
+    def toDict(self):
+        return {
+            'path': self.path,
+            'name': self.name,
+            'actionNeeded': self.actionNeeded,
+            'timedout': self.timedout,
+            'branches': [b.toDict() for b in self.branches],
+        }
+
+    @classmethod
+    def fromDict(cls, content):
+        result = cls(content['path'], content['name'])
+        result.branches = [BranchResult.fromDict(b) for b in content['branches']]
+        result.timedout = content.get('timedout', False)
+        return result
+
+
+# Result of a branch check, files are [state, path] local changes, only
+# listed when they are shown. changes is their number, None when the check
+# stopped at the first one
+class BranchResult:
+    __slots__ = ('name', 'files', 'changes', 'hasremotes', 'remotes')
+
+    def __init__(self, name, files, hasremotes, changes=0):
+        self.name = name
+        self.files = files
+        self.changes = changes if changes != 0 else len(files)
+        self.hasremotes = hasremotes
+        self.remotes = []
+
+    # actionNeeded is branch push/pull, not local file change.
+    @property
+    def actionNeeded(self):
+        return any(r.topush or r.topull for r in self.remotes)
+
+    @property
+    def ischange(self):
+        return self.changes != 0 or self.actionNeeded
+
+    def toDict(self):
+        return {
+            'name': self.name,
+            'files': [{'state': state, 'path': path} for state, path in self.files],
+            'changes': self.changes,
+            'hasremotes': self.hasremotes,
+            'actionNeeded': self.actionNeeded,
+            'remotes': [r.toDict() for r in self.remotes],
+        }
+
+    @classmethod
+    def fromDict(cls, content):
+        files = [[f['state'], f['path']] for f in content['files']]
+        result = cls(content['name'], files, content['hasremotes'], content.get('changes', 0))
+        result.remotes = [RemoteResult.fromDict(r) for r in content['remotes']]
+        return result
+
+
+# Commits to push to and to pull from a remote, the commit lists are only
+# read in verbose mode
+class RemoteResult:
+    __slots__ = ('name', 'topush', 'topull', 'pushcommits', 'pullcommits')
+
+    def __init__(self, name, topush, topull):
+        self.name = name
+        self.topush = topush
+        self.topull = topull
+        self.pushcommits = []
+        self.pullcommits = []
+
+    def toDict(self):
+        return {
+            'name': self.name,
+            'topush': self.topush,
+            'topull': self.topull,
+            'pushcommits': self.pushcommits,
+            'pullcommits': self.pullcommits,
+        }
+
+    @classmethod
+    def fromDict(cls, content):
+        result = cls(content['name'], content['topush'], content['topull'])
+        result.pushcommits = content['pushcommits']
+        result.pullcommits = content['pullcommits']
+        return result
 
 
 def showDebug(mess, level='info'):
@@ -72,240 +304,872 @@ def showDebug(mess, level='info'):
 
 # Search all local repositories from current directory
 def searchRepositories(args):
+    return sorted(set(discoverRepositories(args)))
+
+
+# Yield the repositories of the searched directories as they are found
+def discoverRepositories(args):
     showDebug('Beginning scan... building list of git folders')
-    repo = set()
+    cache = DiscoveryCache(args)
+    if not opts.rescan:
+        cache.load()
+
+    # Searched directories may overlap, a single one can't yield duplicates
+    found = set()
     for curdir in args:
         if curdir[-1:] == '/':
             curdir = curdir[:-1]
         showDebug("  Scan git repositories from %s" % curdir)
 
-        html.path = curdir
-        startinglevel = curdir.count(os.sep)
+        for r in walkRepositories(curdir, curdir, cache):
+            if not isInShard(r):
+                continue
+            if len(args) > 1:
+                if r in found:
+                    continue
+                found.add(r)
+            yield r
+
+    showDebug("  %s directories reused from cache, %s scanned" % (cache.reused, cache.scanned))
+    # Nothing to write when every listing came from the cache
+    if cache.scanned or opts.rescan:
+        cache.save()
+    showDebug('Done')
 
-        for directory, dirnames, filenames in os.walk(curdir):
-            level = directory.count(os.sep) - startinglevel
-            if opts.depth is 0 or level <= opts.depth:
-                if '.git' in dirnames:
-                    showDebug("  Add %s repository" % directory)
-                    repo.add(directory)
 
-    showDebug('Done')
-    return sorted(repo)
-
-
-# Check state of a git repository
-def checkRepository(rep, branch, opts, args):
-    aitem = []
-    mitem = []
-    ditem = []
-    gsearch = re.compile(r'^.?([A-Z]) (.*)')
-    if re.match(opts.ignoreBranch, branch):
-        return False
-
-    changes = getLocalFilesChange(rep, opts)
-    ischange = len(changes) > 0
-    actionNeeded = False  # actionNeeded is branch push/pull, not local file change.
-
-    topush = ""
-    topull = ""
-    html.topush = ""
-    html.topull = ""
-    if branch != "":
-        remotes = getRemoteRepositories(rep)
-        hasremotes = bool(remotes)
-        for r in remotes:
-            count = len(getLocalToPush(rep, r, branch))
-            ischange = ischange or (count > 0)
-            actionNeeded = actionNeeded or (count > 0)
-            if count > 0:
+# Walk a tree and yield the git working trees found, a working tree has a
+# .git directory, or a .git file for worktrees and submodules. Never enter
+# .git nor excluded directories, and stop at opts.depth
+def walkRepositories(curdir, root, cache, level=0):
+    listing = cache.listDirectory(curdir)
+    if listing is None:
+        return
+    isrepo, subdirs = listing
+
+    if isrepo:
+        showDebug("  Add %s repository" % curdir)
+        yield curdir
+        if opts.stopAtRepo:
+            return
+
+    if opts.depth and level >= opts.depth:
+        return
+
+    for name in subdirs:
+        path = os.path.join(curdir, name)
+        if isExcludedDirectory(path, root):
+            showDebug("  Exclude %s" % path)
+            continue
+        for directory in walkRepositories(path, root, cache, level + 1):
+            yield directory
+
+
+# Check a repository belongs to the --shard i/N part, by a stable hash of
+# its path so every node running a shard gets the same partition
+def isInShard(rep):
+    if opts.shard is None:
+        return True
+    index, count = opts.shard
+    return int(hashlib.sha1(rep.encode('utf-8')).hexdigest(), 16) % count == index - 1
+
+
+# Parse the i/N value of --shard
+def parseShard(value):
+    try:
+        index, count = [int(v) for v in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid shard %s, expected i/N" % value)
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("invalid shard %s, expected 1 <= i <= N" % value)
+    return index, count
+
+
+# Check a directory against the --exclude globs, by name or by path
+# relative to the scanned root
+def isExcludedDirectory(path, root):
+    name = os.path.basename(path)
+    relpath = os.path.relpath(path, root)
+    for pattern in opts.excludeDirs:
+        if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relpath, pattern):
+            return True
+    return False
+
+
+# Get the gitcheck cache directory
+def getCacheDir():
+    cachehome = os.environ.get('XDG_CACHE_HOME') or expanduser('~/.cache')
+    return os.path.join(cachehome, 'gitcheck')
+
+
+# Load a JSON file of the cache directory, None if it can't be read
+def loadCacheFile(filename):
+    import json
+    try:
+        with open(filename) as fh:
+            return json.load(fh)
+    except (EnvironmentError, ValueError) as e:
+        showDebug("  No cache: %s" % e)
+        return None
+
+
+# Atomically write a JSON file of the cache directory
+def saveCacheFile(filename, content):
+    import json
+    tmpname = "%s.%s" % (filename, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(tmpname, 'w') as fh:
+            json.dump(content, fh)
+        os.replace(tmpname, filename)
+    except EnvironmentError as e:
+        showDebug("  Unable to save %s: %s" % (filename, e))
+
+
+# Directory listings of previous searches, stored with the directory mtime
+# they were read at, only directories whose mtime changed are scanned again
+class DiscoveryCache:
+    # Directories modified less than this many seconds before being read may
+    # change again within the mtime granularity, they are never reused
+    racyDelay = 2
+
+    def __init__(self, args):
+        import json
+        key = json.dumps([sorted(args), opts.depth, opts.stopAtRepo, sorted(opts.excludeDirs)])
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        self.filename = os.path.join(getCacheDir(), 'discovery-%s.json' % digest)
+        self.entries = {}
+        self.visited = {}
+        self.reused = 0
+        self.scanned = 0
+
+    def load(self):
+        self.entries = loadCacheFile(self.filename) or {}
+
+    def save(self):
+        saveCacheFile(self.filename, self.visited)
+
+    # Return (isrepo, subdirs) for a directory, or None if it can't be read
+    def listDirectory(self, path):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError as e:
+            showDebug("  Skip %s: %s" % (path, e))
+            return None
+
+        entry = self.entries.get(path)
+        if entry is not None and entry['mtime'] == mtime:
+            self.reused += 1
+            self.visited[path] = entry
+            return entry['repo'], entry['subdirs']
+
+        try:
+            entries = sorted(os.scandir(path), key=lambda e: e.name)
+        except OSError as e:
+            showDebug("  Skip %s: %s" % (path, e))
+            return None
+        self.scanned += 1
+
+        isrepo = any(e.name == '.git' for e in entries)
+        subdirs = [e.name for e in entries
+                   if e.name != '.git' and e.is_dir(follow_symlinks=False)]
+        if time.time() - mtime < self.racyDelay:
+            mtime = None
+        self.visited[path] = {'mtime': mtime, 'repo': isrepo, 'subdirs': subdirs}
+        return isrepo, subdirs
+
+
+# Check state of a git repository branch from the repository status and
+# the [remote, ahead, behind] tracking counts of the branch
+def checkRepository(rep, branch, opts, status, hasremotes, tracking):
+    result = BranchResult(branch, status['files'], hasremotes if branch != "" else False, status['changes'])
+    for r, topush, topull in tracking:
+        remote = RemoteResult(r, topush, topull)
+        if opts.verbose:
+            if topush > 0:
+                remote.pushcommits = getLocalToPush(rep, r, branch, opts.maxCommits)
+            if topull > 0:
+                remote.pullcommits = getRemoteToPull(rep, r, branch, opts.maxCommits)
+        result.remotes.append(remote)
+
+    return result
+
+
+# Get the repository name shown in reports
+def getRepositoryName(rep, opts, args):
+    # Remove trailing slash from repository/directory name
+    if rep[-1:] == '/':
+        rep = rep[:-1]
+
+    if opts.full_path:
+        return rep
+
+    # Do some magic to not show the absolute path as repository name
+    for target in args:
+        if rep.startswith(target):
+            #Case 1: script was started in a directory that is a git repo
+            if target == rep:
+                return os.path.basename(rep)
+            # Case 2: script was started in a directory with possible subdirs that contain git repos
+            return rep[len(target)+1:]
+    return rep
+
+
+# Branches shown in reports, only the ones needing action in quiet mode
+def shownBranches(result):
+    return [b for b in result.branches if b.ischange or not opts.quiet]
+
+
+# Render a repository result as terminal lines
+def renderTerminal(result):
+    colortheme = getColorTheme()
+    lines = []
+    if result.timedout:
+        lines.append("%s%s%s timed out" % (colortheme['prjchanged'], result.name, colortheme['default']))
+    for branch in shownBranches(result):
+        if branch.ischange:
+            prjname = "%s%s%s" % (colortheme['prjchanged'], result.name, colortheme['default'])
+        elif not branch.hasremotes:
+            prjname = "%s%s%s" % (colortheme['prjremote'], result.name, colortheme['default'])
+        else:
+            prjname = "%s%s%s" % (colortheme['prjname'], result.name, colortheme['default'])
+
+        strlocal = ""
+        if branch.changes is None:
+            strlocal = "%sLocal%s[%sTo Commit%s]" % (
+                colortheme['reponame'],
+                colortheme['default'],
+                colortheme['remoteto'],
+                colortheme['default']
+            )
+        elif branch.changes:
+            strlocal = "%sLocal%s[%sTo Commit:%s%s]" % (
+                colortheme['reponame'],
+                colortheme['default'],
+                colortheme['remoteto'],
+                colortheme['default'],
+                branch.changes
+            )
+
+        topush = ""
+        topull = ""
+        for r in branch.remotes:
+            if r.topush > 0:
                 topush += " %s%s%s[%sTo Push:%s%s]" % (
                     colortheme['reponame'],
-                    r,
+                    r.name,
                     colortheme['default'],
                     colortheme['remoteto'],
                     colortheme['default'],
-                    count
-                )
-                html.topush += '<b style="color:black">%s</b>[<b style="color:blue">To Push:</b><b style="color:black">%s</b>]' % (
-                    r,
-                    count
+                    r.topush
                 )
-
-        for r in remotes:
-            count = len(getRemoteToPull(rep, r, branch))
-            ischange = ischange or (count > 0)
-            actionNeeded = actionNeeded or (count > 0)
-            if count > 0:
+            if r.topull > 0:
                 topull += " %s%s%s[%sTo Pull:%s%s]" % (
                     colortheme['reponame'],
-                    r,
+                    r.name,
                     colortheme['default'],
                     colortheme['remoteto'],
                     colortheme['default'],
-                    count
-                )
-                html.topull += '<b style="color:black">%s</b>[<b style="color:blue">To Pull:</b><b style="color:black">%s</b>]' % (
-                    r,
-                    count
+                    r.topull
                 )
-    if ischange or not opts.quiet:
-        # Remove trailing slash from repository/directory name
-        if rep[-1:] == '/':
-            rep = rep[:-1]
-
-        if opts.full_path:
-            repname = rep
-        # Do some magic to not show the absolute path as repository name
-        else:
-            for target in  args:
-                if rep.startswith(target):
-                    #Case 1: script was started in a directory that is a git repo
-                    if target == rep:
-                        repname = os.path.basename(rep)
-                    # Case 2: script was started in a directory with possible subdirs that contain git repos
-                    else:
-                        repname = rep[len(target)+1:]
-                    break
-
-        if ischange:
-            prjname = "%s%s%s" % (colortheme['prjchanged'], repname, colortheme['default'])
-            html.prjname = '<b style="color:red">%s</b>' % (repname)
-        elif not hasremotes:
-            prjname = "%s%s%s" % (colortheme['prjremote'], repname, colortheme['default'])
-            html.prjname = '<b style="color:magenta">%s</b>' % (repname)
-        else:
-            prjname = "%s%s%s" % (colortheme['prjname'], repname, colortheme['default'])
-            html.prjname = '<b style="color:green">%s</b>' % (repname)
-
-        # Print result
-        if len(changes) > 0:
-            strlocal = "%sLocal%s[" % (colortheme['reponame'], colortheme['default'])
-            lenFilesChnaged = len(getLocalFilesChange(rep, opts))
-            strlocal += "%sTo Commit:%s%s" % (
-                colortheme['remoteto'],
-                colortheme['default'],
-                lenFilesChnaged
-            )
-            html.strlocal = '<b style="color:orange"> Local</b><b style="color:black">['
-            html.strlocal += "To Commit:%s" % (
-                lenFilesChnaged
-            )
-            strlocal += "]"
-            html.strlocal += "]</b>"
-        else:
-            strlocal = ""
-            html.strlocal = ""
 
-        if opts.email:
-            html.msg += "<li>%s/%s %s %s %s</li>\n" % (html.prjname, branch, html.strlocal, html.topush, html.topull)
-
-        else:
-            cbranch = "%s%s" % (colortheme['branchname'], branch)
-            print("%(prjname)s/%(cbranch)s %(strlocal)s%(topush)s%(topull)s" % locals())
+        cbranch = "%s%s" % (colortheme['branchname'], branch.name)
+        lines.append("%(prjname)s/%(cbranch)s %(strlocal)s%(topush)s%(topull)s" % locals())
 
         if opts.verbose:
-            if ischange > 0:
-                filename = "  |--Local"
-                if not opts.email:
-                    print(filename)
-                html.msg += '<ul><li><b>Local</b></li></ul>\n<ul>\n'
-                for c in changes:
-                    filename = "     |--%s%s%s %s%s" % (
+            if branch.ischange:
+                lines.append("  |--Local")
+                for c in branch.files:
+                    lines.append("     |--%s%s%s %s%s" % (
                         colortheme['commitstate'],
                         c[0],
                         colortheme['fileupdated'],
                         c[1],
-                        colortheme['default'])
-                    html.msg += '<li> <b style="color:orange">[To Commit] </b>%s</li>\n' % c[1]
-                    if not opts.email: print(filename)
-                html.msg += '</ul>\n'
-            if branch != "":
-                remotes = getRemoteRepositories(rep)
-                for r in remotes:
-                    commits = getLocalToPush(rep, r, branch)
-                    if len(commits) > 0:
-                        rname = "  |--%(r)s" % locals()
-                        html.msg += '<ul><li><b>%(r)s</b></li>\n</ul>\n<ul>\n' % locals()
-                        if not opts.email: print(rname)
-                        for commit in commits:
-                            pcommit = "     |--%s[To Push]%s %s%s%s" % (
-                                colortheme['committo'],
-                                colortheme['default'],
-                                colortheme['commitinfo'],
-                                commit,
-                                colortheme['default'])
-                            html.msg += '<li><b style="color:blue">[To Push] </b>%s</li>\n' % commit
-                            if not opts.email: print(pcommit)
-                        html.msg += '</ul>\n'
-
-            if branch != "":
-                remotes = getRemoteRepositories(rep)
-                for r in remotes:
-                    commits = getRemoteToPull(rep, r, branch)
-                    if len(commits) > 0:
-                        rname = "  |--%(r)s" % locals()
-                        html.msg += '<ul><li><b>%(r)s</b></li>\n</ul>\n<ul>\n' % locals()
-                        if not opts.email: print(rname)
-                        for commit in commits:
-                            pcommit = "     |--%s[To Pull]%s %s%s%s" % (
-                                colortheme['committo'],
-                                colortheme['default'],
-                                colortheme['commitinfo'],
-                                commit,
-                                colortheme['default'])
-                            html.msg += '<li><b style="color:blue">[To Pull] </b>%s</li>\n' % commit
-                            if not opts.email: print(pcommit)
-                        html.msg += '</ul>\n'
-
-    return actionNeeded
-
-
-def getLocalFilesChange(rep,opts):
-    files = []
-    #curdir = os.path.abspath(os.getcwd())
-    snbchange = re.compile(r'^(.{2}) (.*)')
-    onlyTrackedArg = "" if opts.checkUntracked else "uno"
-    result = gitExec(rep, "status -s" + onlyTrackedArg)
-
-    lines = result.split('\n')
-    for l in lines:
-        if not re.match(opts.ignoreLocal, l):
-            m = snbchange.match(l)
-            if m:
-                files.append([m.group(1), m.group(2)])
+                        colortheme['default']))
+            for r in branch.remotes:
+                if r.pushcommits:
+                    lines.append("  |--%s" % r.name)
+                    for commit in r.pushcommits:
+                        lines.append("     |--%s[To Push]%s %s%s%s" % (
+                            colortheme['committo'],
+                            colortheme['default'],
+                            colortheme['commitinfo'],
+                            commit,
+                            colortheme['default']))
+                    if r.topush > len(r.pushcommits):
+                        lines.append("     |--...and %s more" % (r.topush - len(r.pushcommits)))
+            for r in branch.remotes:
+                if r.pullcommits:
+                    lines.append("  |--%s" % r.name)
+                    for commit in r.pullcommits:
+                        lines.append("     |--%s[To Pull]%s %s%s%s" % (
+                            colortheme['committo'],
+                            colortheme['default'],
+                            colortheme['commitinfo'],
+                            commit,
+                            colortheme['default']))
+                    if r.topull > len(r.pullcommits):
+                        lines.append("     |--...and %s more" % (r.topull - len(r.pullcommits)))
+
+    return lines
+
+
+# Render a report as the html content of the email
+def renderHtml(report):
+    msg = "<ul>\n"
+    for result in report.repositories:
+        if result.timedout:
+            msg += '<li><b style="color:red">%s</b> timed out</li>\n' % (result.name)
+        for branch in shownBranches(result):
+            if branch.ischange:
+                prjname = '<b style="color:red">%s</b>' % (result.name)
+            elif not branch.hasremotes:
+                prjname = '<b style="color:magenta">%s</b>' % (result.name)
+            else:
+                prjname = '<b style="color:green">%s</b>' % (result.name)
+
+            strlocal = ""
+            if branch.changes is None:
+                strlocal = '<b style="color:orange"> Local</b><b style="color:black">[To Commit]</b>'
+            elif branch.changes:
+                strlocal = '<b style="color:orange"> Local</b><b style="color:black">[To Commit:%s]</b>' % (
+                    branch.changes
+                )
 
-    return files
+            topush = ""
+            topull = ""
+            for r in branch.remotes:
+                if r.topush > 0:
+                    topush += '<b style="color:black">%s</b>[<b style="color:blue">To Push:</b><b style="color:black">%s</b>]' % (
+                        r.name,
+                        r.topush
+                    )
+                if r.topull > 0:
+                    topull += '<b style="color:black">%s</b>[<b style="color:blue">To Pull:</b><b style="color:black">%s</b>]' % (
+                        r.name,
+                        r.topull
+                    )
+            msg += "<li>%s/%s %s %s %s</li>\n" % (prjname, branch.name, strlocal, topush, topull)
+
+            if opts.verbose:
+                if branch.ischange:
+                    msg += '<ul><li><b>Local</b></li></ul>\n<ul>\n'
+                    for c in branch.files:
+                        msg += '<li> <b style="color:orange">[To Commit] </b>%s</li>\n' % c[1]
+                    msg += '</ul>\n'
+                for r in branch.remotes:
+                    if r.pushcommits:
+                        msg += '<ul><li><b>%s</b></li>\n</ul>\n<ul>\n' % r.name
+                        for commit in r.pushcommits:
+                            msg += '<li><b style="color:blue">[To Push] </b>%s</li>\n' % commit
+                        if r.topush > len(r.pushcommits):
+                            msg += '<li>...and %s more</li>\n' % (r.topush - len(r.pushcommits))
+                        msg += '</ul>\n'
+                for r in branch.remotes:
+                    if r.pullcommits:
+                        msg += '<ul><li><b>%s</b></li>\n</ul>\n<ul>\n' % r.name
+                        for commit in r.pullcommits:
+                            msg += '<li><b style="color:blue">[To Pull] </b>%s</li>\n' % commit
+                        if r.topull > len(r.pullcommits):
+                            msg += '<li>...and %s more</li>\n' % (r.topull - len(r.pullcommits))
+                        msg += '</ul>\n'
+
+    msg += "</ul>\n<p>Report created on %s</p>\n" % report.timestamp
+    return msg
+
+
+# Render a report as JSON, with the branches shown by the terminal output
+def renderJson(report):
+    import json
+    content = report.toDict()
+    for repository in content['repositories']:
+        repository['branches'] = [b for b in repository['branches']
+                                  if b['actionNeeded'] or b['changes'] != 0 or not opts.quiet]
+    content['repositories'] = [r for r in content['repositories'] if r['branches'] or r['timedout']]
+    return json.dumps(content, indent=2)
+
+
+# One JSON line per shown branch of a repository, for --format jsonl
+def renderJsonLines(result):
+    import json
+    lines = []
+    if result.timedout:
+        lines.append(json.dumps({'type': 'timeout', 'path': result.path, 'repository': result.name}))
+    for branch in shownBranches(result):
+        record = {
+            'type': 'branch',
+            'path': result.path,
+            'repository': result.name,
+            'branch': branch.toDict(),
+        }
+        lines.append(json.dumps(record))
+    return lines
+
+
+# Last JSON line of --format jsonl, totals of the whole run
+def renderJsonSummary(report):
+    import json
+    branches = [b for r in report.repositories for b in r.branches]
+    summary = {
+        'type': 'summary',
+        'path': report.path,
+        'timestamp': report.timestamp,
+        'repositories': len(report.repositories),
+        'branches': len(branches),
+        'toCommit': sum(1 for b in branches if b.changes != 0),
+        'toPush': sum(1 for b in branches if any(r.topush for r in b.remotes)),
+        'toPull': sum(1 for b in branches if any(r.topull for r in b.remotes)),
+        'timedOut': sum(1 for r in report.repositories if r.timedout),
+        'actionNeeded': report.actionNeeded,
+    }
+    return json.dumps(summary)
+
+
+def getLocalFilesChange(rep, opts):
+    return getRepositoryStatus(rep, opts)['files']
+
+
+# How local changes are read: 'files' lists them for verbose and json
+# output, 'dirty' stops at the first one in quiet mode, 'count' counts them
+def getStatusMode(opts):
+    if opts.verbose or opts.format in ('json', 'jsonl') or opts.daemon:
+        return 'files'
+    if opts.quiet:
+        return 'dirty'
+    return 'count'
+
+
+# Read local changes and the tracking state of the current branch with a
+# single 'git status --porcelain=v2' call. In 'dirty' mode git is stopped at
+# the first change, changes is then None
+def getRepositoryStatus(rep, opts, mode='files'):
+    status = {
+        'files': [],
+        'changes': 0,
+        'head': None,
+        'upstream': None,
+        'ahead': 0,
+        'behind': 0,
+    }
+    onlyTrackedArg = "" if opts.checkUntracked else " -uno"
+    cmd = "status --porcelain=v2 --branch -z" + onlyTrackedArg
+    pathspecs = getIgnorePathspecs(rep, opts)
+    if pathspecs:
+        cmd += " -- . " + " ".join(shlex.quote(p) for p in pathspecs)
+    if mode == 'dirty':
+        # The branch headers come first, before the changes
+        entries = gitExecEntries(rep, cmd)
+    else:
+        entries = iter(gitExec(rep, cmd).split('\0'))
+
+    addChanges(status, readStatusEntries(entries, status), opts, mode)
+    if mode == 'dirty':
+        entries.close()
+    return status
+
+
+# Count (and in 'files' mode list) the [state, path] changes not matching
+# --localignore, in 'dirty' mode stop at the first one
+def addChanges(status, changes, opts, mode):
+    ignore = re.compile(opts.ignoreLocal)
+    for state, path in changes:
+        # Keep 'git status -s' line format for the ignore regex
+        if ignore.match("%s %s" % (state, path)):
+            continue
+        if mode == 'dirty':
+            status['changes'] = None
+            return
+        status['changes'] += 1
+        if mode == 'files':
+            status['files'].append([state, path])
+
+
+# Globs of the --ignore-path options and of the .gitcheckignore file of the
+# repository. As in .gitignore, a glob without a slash matches at any depth
+# and a leading slash anchors it at the top of the repository
+def getIgnoreGlobs(rep, opts):
+    globs = list(opts.ignorePaths)
+    try:
+        with open(os.path.join(rep, '.gitcheckignore')) as fh:
+            # The ignore file itself is not a change to show
+            globs.append('/.gitcheckignore')
+            for line in fh:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    globs.append(line)
+    except EnvironmentError:
+        pass
+
+    normalized = []
+    for glob in globs:
+        glob = glob.rstrip('/')
+        if glob.startswith('/'):
+            glob = glob.lstrip('/')
+        elif '/' not in glob:
+            glob = '**/' + glob
+        if glob:
+            normalized.append(glob)
+    return normalized
+
+
+# Exclude pathspecs of the ignored globs, git then doesn't even walk the
+# excluded trees
+def getIgnorePathspecs(rep, opts):
+    pathspecs = []
+    for glob in getIgnoreGlobs(rep, opts):
+        pathspecs.append(':(exclude,glob)%s' % glob)
+        pathspecs.append(':(exclude,glob)%s/**' % glob)
+    return pathspecs
+
+
+# Match a path of the status against the ignored globs, for the backends
+# which can't use pathspecs
+def isIgnoredPath(path, globs):
+    path = path.rstrip('/')
+    for glob in globs:
+        patterns = [glob, glob + '/*']
+        if glob.startswith('**/'):
+            patterns += [glob[3:], glob[3:] + '/*']
+        if any(fnmatch.fnmatch(path, p) for p in patterns):
+            return True
+    return False
+
+
+# Parse 'git status --porcelain=v2 --branch -z' entries, store the branch
+# headers in status and yield the [state, path] local changes
+def readStatusEntries(entries, status):
+    # Number of space separated fields before the path, by entry type
+    nbfields = {'1': 8, '2': 9, 'u': 10}
+    for entry in entries:
+        if entry.startswith('# '):
+            key, _, value = entry[2:].partition(' ')
+            if key == 'branch.head':
+                status['head'] = value
+            elif key == 'branch.upstream':
+                status['upstream'] = value
+            elif key == 'branch.ab':
+                ahead, behind = value.split()
+                status['ahead'] = int(ahead)
+                status['behind'] = -int(behind)
+            continue
+
+        kind = entry[:1]
+        if kind in nbfields:
+            fields = entry.split(' ', nbfields[kind])
+            state = fields[1].replace('.', ' ')
+            path = fields[-1]
+            if kind == '2':
+                # Renamed or copied, the original path is the next entry
+                path = "%s -> %s" % (next(entries), path)
+        elif kind in ('?', '!'):
+            state = kind * 2
+            path = entry[2:]
+        else:
+            continue
+
+        yield state, path
+
+
+# Get {branch: [[remote, ahead, behind]]} for every branch and every remote
+# which has a branch with the same name. Branches at the same commit as
+# their remote branch need no git call, the upstream counts come from
+# 'git status' for the current branch and from a single 'git for-each-ref'
+# for the other branches, only remaining pairs run 'git rev-list'
+def getTrackingCounts(rep, branches, status):
+    remotes = getRemoteRepositories(rep)
+    refs = getRefs(rep)
+
+    tracking = dict((b, []) for b in branches)
+    upstreams = None
+    for branch in branches:
+        local = refs.get('refs/heads/%s' % branch)
+        for remote in remotes:
+            remoteref = 'refs/remotes/%s/%s' % (remote, branch)
+            if remoteref not in refs:
+                continue
+            if refs[remoteref] == local:
+                counts = [0, 0]
+            elif status['head'] == branch and status['upstream'] == '%s/%s' % (remote, branch):
+                counts = [status['ahead'], status['behind']]
+            else:
+                if upstreams is None:
+                    upstreams = getUpstreamCounts(rep)
+                counts = upstreams.get((branch, remoteref))
+                if counts is None:
+                    result = gitExec(rep, "rev-list --left-right --count %(branch)s...%(remote)s/%(branch)s"
+                                     % locals())
+                    counts = [int(c) for c in result.split()]
+            tracking[branch].append([remote] + counts)
+
+    return bool(remotes), tracking
+
+
+# Get {(branch, upstream ref): [ahead, behind]} of all local branches with
+# an upstream, from one 'git for-each-ref' call
+def getUpstreamCounts(rep):
+    result = gitExec(rep, "for-each-ref --format=%(refname)%09%(upstream)%09%(upstream:track,nobracket) refs/heads")
+    counts = {}
+    for line in result.splitlines():
+        refname, upstream, track = (line.split('\t') + ['', ''])[:3]
+        if not upstream or track == 'gone':
+            continue
+        ahead = re.search(r'ahead (\d+)', track)
+        behind = re.search(r'behind (\d+)', track)
+        counts[(refname[len('refs/heads/'):], upstream)] = [
+            int(ahead.group(1)) if ahead else 0,
+            int(behind.group(1)) if behind else 0,
+        ]
+    return counts
 
 
 def hasRemoteBranch(rep, remote, branch):
-    result = gitExec(rep, 'branch -r')
-    return '%s/%s' % (remote, branch) in result
+    return '%s/%s' % (remote, branch) in getRemoteBranches(rep)
 
 
-def getLocalToPush(rep, remote, branch):
+# Get at most limit commits to push (0 for all of them)
+def getLocalToPush(rep, remote, branch, limit=0):
     if not hasRemoteBranch(rep, remote, branch):
         return []
-    result = gitExec(rep, "log %(remote)s/%(branch)s..%(branch)s --oneline"
-                     % locals())
-
-    return [x for x in result.split('\n') if x]
+    return getBackend().getCommits(rep, "%s/%s" % (remote, branch), branch, limit)
 
 
-def getRemoteToPull(rep, remote, branch):
+# Get at most limit commits to pull (0 for all of them)
+def getRemoteToPull(rep, remote, branch, limit=0):
     if not hasRemoteBranch(rep, remote, branch):
         return []
-    result = gitExec(rep, "log %(branch)s..%(remote)s/%(branch)s --oneline"
-                     % locals())
-
-    return [x for x in result.split('\n') if x]
+    return getBackend().getCommits(rep, branch, "%s/%s" % (remote, branch), limit)
 
 
 def updateRemote(rep):
     gitExec(rep, "remote update")
 
 
+# Get the host of a remote url, local paths and file:// urls have no host
+def getUrlHost(url):
+    m = re.match(r'^[a-z][a-z0-9+.-]*://(?:[^@/]*@)?(\[[^\]]*\]|[^:/]*)', url, flags=re.IGNORECASE)
+    if m:
+        return m.group(1).lower()
+    # scp-like syntax [user@]host:path
+    m = re.match(r'^(?:[^@/]*@)?([^:/]+):', url)
+    if m and not os.path.exists(url):
+        return m.group(1).lower()
+    return ''
+
+
+# Fetch the remotes of many repositories concurrently. Remotes are fetched
+# once per object store, so worktrees of a repository share their fetches,
+# at most opts.fetchJobs fetches run at a time, opts.fetchHostJobs per host
+class FetchScheduler:
+    def __init__(self, opts):
+        from concurrent.futures import ThreadPoolExecutor
+        self.jobs = opts.fetchJobs
+        self.hostjobs = opts.fetchHostJobs
+        self.timeout = opts.fetchTimeout
+        self.pool = ThreadPoolExecutor(max_workers=self.jobs)
+        self.lock = threading.Lock()
+        self.fetches = {}
+        self.repos = {}
+        self.pending = {}
+        self.running = Counter()
+        self.total = 0
+        self.started = time.time()
+        self.finished = self.started
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+    # Schedule the remote fetches of a repository
+    def schedule(self, rep):
+        from concurrent.futures import Future
+        try:
+            gitdir, commondir = getGitDirs(rep)
+            remotes = readRemotes(commondir)
+            tasks = [((commondir, name), name, getUrlHost(remote.get('url', '')))
+                     for name, remote in sorted(remotes.items())
+                     if remote.get('skipdefaultupdate', 'false').lower() not in ('true', 'yes', 'on', '1')]
+        except (UnsupportedLayout, EnvironmentError) as e:
+            showDebug("  %s: %s, updating all remotes at once" % (rep, e))
+            tasks = [((rep, None), None, '')]
+
+        self.repos[rep] = []
+        with self.lock:
+            for key, remote, host in tasks:
+                if key not in self.fetches:
+                    self.fetches[key] = Future()
+                    self.pending.setdefault(host, []).append((rep, remote, key))
+                    self.total += 1
+                self.repos[rep].append(self.fetches[key])
+            self.dispatch()
+
+    # Start pending fetches while the global and per host limits allow it,
+    # must be called with the lock held
+    def dispatch(self):
+        for host in sorted(self.pending, key=lambda h: self.running[h]):
+            while self.pending[host] and sum(self.running.values()) < self.jobs \
+                    and self.running[host] < self.hostjobs:
+                rep, remote, key = self.pending[host].pop(0)
+                self.running[host] += 1
+                self.pool.submit(self.fetch, rep, remote, key, host)
+
+    # Fetch a remote, all of them when remote is None
+    def fetch(self, rep, remote, key, host):
+        try:
+            getBackend().fetch(rep, remote, self.timeout)
+        except Exception as e:
+            print("Failed updating %s remotes: %s" % (rep, e), file=sys.stderr)
+        finally:
+            with self.lock:
+                self.running[host] -= 1
+                self.finished = time.time()
+                self.dispatch()
+            self.fetches[key].set_result(None)
+
+    # Submit fn(*args) to pool once the fetches of rep are done, return a
+    # future of its result
+    def then(self, rep, pool, fn, *args):
+        from concurrent.futures import Future
+        result = Future()
+        fetches = self.repos.get(rep, [])
+        remaining = [len(fetches)]
+        lock = threading.Lock()
+
+        def transfer(inner):
+            if inner.exception() is not None:
+                result.set_exception(inner.exception())
+            else:
+                result.set_result(inner.result())
+
+        def start(done=None):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            pool.submit(fn, *args).add_done_callback(transfer)
+
+        if not fetches:
+            remaining[0] = 1
+            start()
+        for f in fetches:
+            f.add_done_callback(start)
+        return result
+
+
+# Raised by the refs reader on a repository layout it does not understand
+class UnsupportedLayout(Exception):
+    pass
+
+
+# Get (gitdir, commondir) of a working tree, following '.git' files
+# used by worktrees and submodules
+def getGitDirs(rep):
+    gitdir = os.path.join(rep, '.git')
+    if os.path.isfile(gitdir):
+        with open(gitdir) as fh:
+            content = fh.read().strip()
+        if not content.startswith('gitdir: '):
+            raise UnsupportedLayout("unknown .git file format")
+        gitdir = os.path.join(rep, content[len('gitdir: '):])
+    elif not os.path.isdir(gitdir):
+        raise UnsupportedLayout("no .git directory")
+
+    commondir = gitdir
+    commonfile = os.path.join(gitdir, 'commondir')
+    if os.path.isfile(commonfile):
+        with open(commonfile) as fh:
+            commondir = os.path.join(gitdir, fh.read().strip())
+
+    if os.path.exists(os.path.join(commondir, 'reftable')):
+        raise UnsupportedLayout("reftable storage")
+    return os.path.normpath(gitdir), os.path.normpath(commondir)
+
+
+# Read HEAD, return ('ref', refname) or ('detached', sha)
+def readHead(gitdir):
+    with open(os.path.join(gitdir, 'HEAD')) as fh:
+        head = fh.read().strip()
+    if head.startswith('ref: '):
+        return 'ref', head[len('ref: '):]
+    if re.match(r'^[0-9a-f]{40}([0-9a-f]{24})?$', head):
+        return 'detached', head
+    raise UnsupportedLayout("unknown HEAD format")
+
+
+# Read refs below prefix from packed-refs and loose ref files, return
+# {refname: value}, symbolic refs keep their 'ref: ' value
+def readRefs(commondir, prefix):
+    refs = {}
+    packed = os.path.join(commondir, 'packed-refs')
+    if os.path.isfile(packed):
+        with open(packed) as fh:
+            for line in fh:
+                if line.startswith(('#', '^')):
+                    continue
+                sha, _, refname = line.rstrip('\n').partition(' ')
+                if refname.startswith(prefix):
+                    refs[refname] = sha
+
+    # Loose refs take precedence over packed ones
+    loose = os.path.join(commondir, prefix)
+    if os.path.isfile(loose):
+        walk = [(os.path.dirname(loose), [], [os.path.basename(loose)])]
+    else:
+        walk = os.walk(loose)
+    for directory, dirnames, filenames in walk:
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            refname = os.path.relpath(path, commondir).replace(os.sep, '/')
+            with open(path) as fh:
+                value = fh.read().strip()
+            if value:
+                refs[refname] = value
+
+    return refs
+
+
+# Read the [remote "<name>"] sections of the git config, return
+# {name: {key: value}} with lowercase keys
+def readRemotes(commondir):
+    remotes = {}
+    section = re.compile(r'^\s*\[\s*([^\s"\]]+)\s*(?:"((?:[^"\\]|\\.)*)")?\s*\]')
+    variable = re.compile(r'^\s*([A-Za-z][A-Za-z0-9-]*)\s*(?:=\s*(.*?))?\s*$')
+    current = None
+    with open(os.path.join(commondir, 'config')) as fh:
+        for line in fh:
+            m = section.match(line)
+            if m:
+                name = m.group(1).lower()
+                if name.startswith('include') or '.' in name:
+                    raise UnsupportedLayout("config includes or legacy sections")
+                current = None
+                if name == 'remote' and m.group(2) is not None:
+                    current = remotes.setdefault(re.sub(r'\\(.)', r'\1', m.group(2)), {})
+                continue
+            m = variable.match(line)
+            if current is not None and m:
+                value = m.group(2) or ''
+                if len(value) > 1 and value[0] == value[-1] == '"':
+                    value = value[1:-1]
+                current[m.group(1).lower()] = value
+
+    return remotes
+
+
 # Get Default branch for repository
 def getDefaultBranch(rep):
+    try:
+        gitdir, commondir = getGitDirs(rep)
+        kind, head = readHead(gitdir)
+        if kind == 'detached':
+            return {'(HEAD detached at %s)' % head[:7]}
+        if not head.startswith('refs/heads/'):
+            raise UnsupportedLayout("HEAD points outside refs/heads")
+        # An unborn branch is not listed by 'git branch'
+        if head not in readRefs(commondir, head):
+            return {""}
+        return {head[len('refs/heads/'):]}
+    except (UnsupportedLayout, EnvironmentError) as e:
+        showDebug("  %s: %s, asking git" % (rep, e))
+
     sbranch = re.compile(r'^\* (.*)', flags=re.MULTILINE)
     gitbranch = gitExec(rep, "branch"
                         % locals())
@@ -320,6 +1184,16 @@ def getDefaultBranch(rep):
 
 # Get all branches for repository
 def getAllBranches(rep):
+    try:
+        gitdir, commondir = getGitDirs(rep)
+        kind, head = readHead(gitdir)
+        branch = sorted(r[len('refs/heads/'):] for r in readRefs(commondir, 'refs/heads/'))
+        if kind == 'detached':
+            branch.insert(0, '(HEAD detached at %s)' % head[:7])
+        return branch
+    except (UnsupportedLayout, EnvironmentError) as e:
+        showDebug("  %s: %s, asking git" % (rep, e))
+
     gitbranch = gitExec(rep, "branch"
                         % locals())
 
@@ -328,7 +1202,39 @@ def getAllBranches(rep):
     return [b[2:] for b in branch]
 
 
+# Get {refname: sha} of the local and remote-tracking branches
+def getRefs(rep):
+    try:
+        gitdir, commondir = getGitDirs(rep)
+        refs = readRefs(commondir, 'refs/heads/')
+        refs.update(readRefs(commondir, 'refs/remotes/'))
+        return refs
+    except (UnsupportedLayout, EnvironmentError) as e:
+        showDebug("  %s: %s, asking git" % (rep, e))
+
+    result = gitExec(rep, "for-each-ref --format=%(refname)%09%(objectname) refs/heads refs/remotes")
+    return dict(line.split('\t', 1) for line in result.splitlines())
+
+
+# Get remote-tracking branches as a set of '<remote>/<branch>' names
+def getRemoteBranches(rep):
+    try:
+        gitdir, commondir = getGitDirs(rep)
+        return set(r[len('refs/remotes/'):] for r in readRefs(commondir, 'refs/remotes/'))
+    except (UnsupportedLayout, EnvironmentError) as e:
+        showDebug("  %s: %s, asking git" % (rep, e))
+
+    result = gitExec(rep, 'branch -r')
+    return set(x.strip().split(' -> ')[0] for x in result.splitlines())
+
+
 def getRemoteRepositories(rep):
+    try:
+        gitdir, commondir = getGitDirs(rep)
+        return sorted(readRemotes(commondir))
+    except (UnsupportedLayout, EnvironmentError) as e:
+        showDebug("  %s: %s, asking git" % (rep, e))
+
     result = gitExec(rep, "remote"
                      % locals())
 
@@ -336,54 +1242,969 @@ def getRemoteRepositories(rep):
     return remotes
 
 
-def gitExec(path, cmd):
+# Raised when a git command runs out of time
+class GitTimeout(Exception):
+    pass
+
+
+# Time limits of git commands, deadline is the time.time() by which the
+# current run must end, None without --deadline
+class limits:
+    deadline = None
+
+
+# Timeout of a git command, --timeout when timeout is None and no limit when
+# it is 0, cut to the time left before the deadline
+def getCommandTimeout(timeout):
+    if timeout is None:
+        timeout = opts.timeout
+    timeout = timeout or None
+    if limits.deadline is not None:
+        left = limits.deadline - time.time()
+        if left <= 0:
+            raise GitTimeout("deadline reached")
+        timeout = left if timeout is None else min(timeout, left)
+    return timeout
+
+
+# Kill a git command started with a timeout, and the processes it started
+# (hooks, credential helpers) which would keep its output open
+def killCommand(p):
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except (AttributeError, OSError):
+        p.kill()
+
+
+def gitExec(path, cmd, timeout=None):
     commandToExecute = "git -C \"%s\" %s" % (path, cmd)
     cmdargs = shlex.split(commandToExecute)
+    timeout = getCommandTimeout(timeout)
     showDebug("EXECUTE GIT COMMAND '%s'" % cmdargs)
-    p = subprocess.Popen(cmdargs, stdout=PIPE, stderr=PIPE)
-    output, errors = p.communicate()
+    with gitstats.lock:
+        gitstats.commands[path] += 1
+    start = time.time()
+    output = b''
+    p = subprocess.Popen(cmdargs, stdout=PIPE, stderr=PIPE, start_new_session=timeout is not None)
+    try:
+        output, errors = p.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        killCommand(p)
+        p.communicate()
+        print('Timeout running %s' % commandToExecute, file=sys.stderr)
+        raise GitTimeout("timed out after %.1f seconds" % timeout)
+    finally:
+        profileEvent('command', cmd, start, time.time() - start,
+                     repository=path, returncode=p.returncode, size=len(output))
     if p.returncode:
-        print('Failed running %s' % commandToExecute)
+        print('Failed running %s' % commandToExecute, file=sys.stderr)
         raise Exception(errors)
     return output.decode('utf-8')
 
 
-# Check all git repositories
-def gitcheck(args):
+# Run a git command and yield its NUL separated output entries while it is
+# running, git is killed when the caller stops reading
+def gitExecEntries(path, cmd):
+    commandToExecute = "git -C \"%s\" %s" % (path, cmd)
+    cmdargs = shlex.split(commandToExecute)
+    timeout = getCommandTimeout(None)
+    showDebug("EXECUTE GIT COMMAND '%s'" % cmdargs)
+    with gitstats.lock:
+        gitstats.commands[path] += 1
+    start = time.time()
+    size = 0
+    p = subprocess.Popen(cmdargs, stdout=PIPE, stderr=PIPE, start_new_session=timeout is not None)
+    expired = threading.Event()
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, lambda: (expired.set(), killCommand(p)))
+        timer.start()
+    try:
+        pending = b''
+        for chunk in iter(lambda: p.stdout.read1(65536), b''):
+            size += len(chunk)
+            entries = (pending + chunk).split(b'\0')
+            pending = entries.pop()
+            for entry in entries:
+                yield entry.decode('utf-8')
+        errors = p.stderr.read()
+        if p.wait() and expired.is_set():
+            print('Timeout running %s' % commandToExecute, file=sys.stderr)
+            raise GitTimeout("timed out after %.1f seconds" % timeout)
+        if p.returncode:
+            print('Failed running %s' % commandToExecute, file=sys.stderr)
+            raise Exception(errors)
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if p.poll() is None:
+            p.kill()
+        p.stdout.close()
+        p.stderr.close()
+        p.wait()
+        profileEvent('command', cmd, start, time.time() - start,
+                     repository=path, returncode=p.returncode, size=size)
+
+
+# Git access of the checks, runs git commands. Branches, refs and remotes
+# are read from .git in-process when the layout is understood
+class SubprocessBackend:
+    name = 'subprocess'
+
+    def getBranches(self, rep):
+        return getAllBranches(rep)
+
+    def getDefaultBranch(self, rep):
+        return getDefaultBranch(rep)
+
+    def getRemotes(self, rep):
+        return getRemoteRepositories(rep)
+
+    def getStatus(self, rep, opts, mode):
+        return getRepositoryStatus(rep, opts, mode)
+
+    def getTrackingCounts(self, rep, branches, status):
+        return getTrackingCounts(rep, branches, status)
+
+    # One line 'sha subject' per commit of tip not in base, at most limit
+    # of them (0 for all)
+    def getCommits(self, rep, base, tip, limit):
+        result = gitExec(rep, "log %s..%s --oneline%s" % (base, tip, " -n %d" % limit if limit else ""))
+        return [x for x in result.split('\n') if x]
+
+    def fetch(self, rep, remote, timeout):
+        if remote is None:
+            gitExec(rep, "remote update", timeout=timeout)
+        else:
+            gitExec(rep, "fetch %s" % shlex.quote(remote), timeout=timeout)
+
+
+# In-process git access with libgit2 through pygit2, status, ahead/behind
+# counts and commits don't fork git. Fetches still run git, which knows the
+# user's credential helpers and ssh setup. Falls back to git on errors.
+# --timeout and --deadline can't interrupt in-process calls
+class Pygit2Backend(SubprocessBackend):
+    name = 'pygit2'
+
+    # Index and working tree flags of libgit2 as 'git status -s' letters
+    indexstates = [
+        ('GIT_STATUS_INDEX_NEW', 'A'),
+        ('GIT_STATUS_INDEX_MODIFIED', 'M'),
+        ('GIT_STATUS_INDEX_DELETED', 'D'),
+        ('GIT_STATUS_INDEX_RENAMED', 'R'),
+        ('GIT_STATUS_INDEX_TYPECHANGE', 'T'),
+    ]
+    worktreestates = [
+        ('GIT_STATUS_WT_MODIFIED', 'M'),
+        ('GIT_STATUS_WT_DELETED', 'D'),
+        ('GIT_STATUS_WT_RENAMED', 'R'),
+        ('GIT_STATUS_WT_TYPECHANGE', 'T'),
+    ]
+
+    def open(self, rep):
+        import pygit2
+        return pygit2.Repository(rep)
+
+    def getState(self, flags):
+        import pygit2
+        if flags & pygit2.GIT_STATUS_CONFLICTED:
+            return 'UU'
+        if flags & pygit2.GIT_STATUS_WT_NEW:
+            return '??'
+        index = [c for f, c in self.indexstates if flags & getattr(pygit2, f)][:1] or [' ']
+        worktree = [c for f, c in self.worktreestates if flags & getattr(pygit2, f)][:1] or [' ']
+        return index[0] + worktree[0]
+
+    # {new path: old path} of the renames staged in the index, detected
+    # like git status does, between HEAD and the index
+    def getRenames(self, repo):
+        import pygit2
+        if repo.head_is_unborn:
+            return {}
+        diff = repo.index.diff_to_tree(repo.head.peel(pygit2.Tree))
+        diff.find_similar()
+        return dict((d.new_file.path, d.old_file.path) for d in diff.deltas
+                    if d.status == pygit2.GIT_DELTA_RENAMED)
+
+    def getStatus(self, rep, opts, mode):
+        import pygit2
+        start = time.time()
+        try:
+            repo = self.open(rep)
+            flags = repo.status(untracked_files='normal' if opts.checkUntracked else 'no')
+            renames = {}
+            if any(f & pygit2.GIT_STATUS_INDEX_NEW for f in flags.values()) and \
+                    any(f & pygit2.GIT_STATUS_INDEX_DELETED for f in flags.values()):
+                renames = self.getRenames(repo)
+        except pygit2.GitError as e:
+            showDebug("  %s: %s, asking git" % (rep, e))
+            return SubprocessBackend.getStatus(self, rep, opts, mode)
+        finally:
+            profileEvent('command', 'pygit2 status', start, time.time() - start, repository=rep)
+
+        status = {
+            'files': [],
+            'changes': 0,
+            'head': None,
+            'upstream': None,
+            'ahead': 0,
+            'behind': 0,
+        }
+        globs = getIgnoreGlobs(rep, opts)
+        renamed = set(renames.values())
+        changes = []
+        for path, f in flags.items():
+            if f & pygit2.GIT_STATUS_IGNORED or isIgnoredPath(path, globs):
+                continue
+            # A renamed path is shown once, as 'old -> new'
+            if path in renamed and not f & pygit2.GIT_STATUS_WT_NEW:
+                continue
+            state = self.getState(f)
+            shown = path
+            if path in renames:
+                state = 'R' + state[1]
+                shown = "%s -> %s" % (renames[path], path)
+            changes.append((state == '??', path, state, shown))
+        # Same order as git, tracked files first
+        changes.sort()
+        addChanges(status, [(state, shown) for _, _, state, shown in changes], opts, mode)
+        return status
+
+    def getTrackingCounts(self, rep, branches, status):
+        import pygit2
+        remotes = self.getRemotes(rep)
+        refs = getRefs(rep)
+
+        tracking = dict((b, []) for b in branches)
+        try:
+            repo = self.open(rep)
+            for branch in branches:
+                local = refs.get('refs/heads/%s' % branch)
+                for remote in remotes:
+                    remoteref = 'refs/remotes/%s/%s' % (remote, branch)
+                    if remoteref not in refs:
+                        continue
+                    if refs[remoteref] == local:
+                        counts = [0, 0]
+                    else:
+                        counts = list(repo.ahead_behind(pygit2.Oid(hex=local), pygit2.Oid(hex=refs[remoteref])))
+                    tracking[branch].append([remote] + counts)
+        except (pygit2.GitError, KeyError, ValueError, TypeError) as e:
+            showDebug("  %s: %s, asking git" % (rep, e))
+            return SubprocessBackend.getTrackingCounts(self, rep, branches, status)
+
+        return bool(remotes), tracking
+
+    def getCommits(self, rep, base, tip, limit):
+        import pygit2
+        start = time.time()
+        try:
+            repo = self.open(rep)
+            walker = repo.walk(repo.revparse_single(tip).id, pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_TIME)
+            walker.hide(repo.revparse_single(base).id)
+            commits = []
+            for commit in walker:
+                # The subject is the first paragraph of the message
+                subject = ' '.join(commit.message.strip().split('\n\n')[0].split())
+                commits.append("%s %s" % (commit.short_id, subject))
+                if limit and len(commits) >= limit:
+                    break
+            return commits
+        except (pygit2.GitError, KeyError) as e:
+            showDebug("  %s: %s, asking git" % (rep, e))
+            return SubprocessBackend.getCommits(self, rep, base, tip, limit)
+        finally:
+            profileEvent('command', 'pygit2 log %s..%s' % (base, tip), start, time.time() - start, repository=rep)
+
+
+backends = {}
+
+
+# Get the --backend used by the checks
+def getBackend():
+    if opts.backend not in backends:
+        backends[opts.backend] = {
+            'subprocess': SubprocessBackend,
+            'pygit2': Pygit2Backend,
+        }[opts.backend]()
+    return backends[opts.backend]
+
+
+# Check all branches of a repository, reusing the cached result when the
+# repository fingerprint did not change
+def checkRepositoryBranches(rep, opts, args, cache=None):
+    start = time.time()
+    try:
+        return checkRepositoryState(rep, opts, args, cache)
+    except GitTimeout as e:
+        showDebug("  %s: %s" % (rep, e))
+        result = RepoResult(rep, getRepositoryName(rep, opts, args))
+        result.timedout = True
+        return result
+    finally:
+        duration = time.time() - start
+        with gitstats.lock:
+            gitstats.durations[rep] = duration
+        profileEvent('repository', rep, start, duration)
+
+
+def checkRepositoryState(rep, opts, args, cache):
+    # Raises GitTimeout past the deadline, whatever the backend runs
+    getCommandTimeout(None)
+    name = getRepositoryName(rep, opts, args)
+    backend = getBackend()
+    if opts.checkall:
+        branch = backend.getBranches(rep)
+    else:
+        branch = backend.getDefaultBranch(rep)
+
+    fingerprint = None
+    if cache is not None:
+        fingerprint = getFingerprint(rep, name, branch, opts)
+        result = cache.get(rep, fingerprint)
+        if result is not None:
+            showDebug("  %s: unchanged, reusing cached result" % rep)
+            return result
+
+    result = RepoResult(rep, name)
+    branch = [b for b in branch if not re.match(opts.ignoreBranch, b)]
+    if branch:
+        # Local changes don't depend on the branch, read them once
+        status = backend.getStatus(rep, opts, getStatusMode(opts))
+        hasremotes, tracking = backend.getTrackingCounts(rep, branch, status)
+        for b in branch:
+            result.branches.append(checkRepository(rep, b, opts, status, hasremotes, tracking[b]))
+    showDebug("  %s: %s git commands" % (rep, gitstats.commands[rep]))
+
+    if fingerprint is not None:
+        cache.put(rep, fingerprint, result)
+    return result
+
+
+# Fingerprint of everything a check depends on: stats of the index, HEAD,
+# packed-refs, FETCH_HEAD, config and the loose refs of the checked branches
+# and their remote branches, the options, and in deep mode the stats of the
+# working tree. None if the repository can't be fingerprinted
+def getFingerprint(rep, name, branches, opts):
+    import json
+    try:
+        gitdir, commondir = getGitDirs(rep)
+        remotes = readRemotes(commondir)
+    except (UnsupportedLayout, EnvironmentError):
+        return None
+
+    paths = [
+        os.path.join(gitdir, 'index'),
+        os.path.join(gitdir, 'HEAD'),
+        os.path.join(gitdir, 'FETCH_HEAD'),
+        os.path.join(commondir, 'FETCH_HEAD'),
+        os.path.join(commondir, 'packed-refs'),
+        os.path.join(commondir, 'config'),
+        os.path.join(rep, '.gitcheckignore'),
+    ]
+    for b in sorted(branches):
+        paths.append(os.path.join(commondir, 'refs', 'heads', b))
+        for r in sorted(remotes):
+            paths.append(os.path.join(commondir, 'refs', 'remotes', r, b))
+
+    now = time.time()
+    stats = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            stats.append((path, None))
+            continue
+        # A file modified within the mtime granularity may change unnoticed
+        if now - st.st_mtime < ResultCache.racyDelay:
+            return None
+        stats.append((path, st.st_mtime_ns, st.st_size))
+
+    if opts.cacheDeep:
+        for directory, dirnames, filenames in os.walk(rep):
+            dirnames[:] = sorted(d for d in dirnames if d != '.git')
+            for filename in [''] + sorted(filenames):
+                try:
+                    st = os.lstat(os.path.join(directory, filename))
+                except OSError:
+                    continue
+                if now - st.st_mtime < ResultCache.racyDelay:
+                    return None
+                stats.append((directory, filename, st.st_mtime_ns, st.st_size))
+
+    options = [name, sorted(branches), opts.checkUntracked, opts.ignoreLocal, opts.ignoreBranch, opts.verbose,
+               opts.maxCommits, getStatusMode(opts), opts.ignorePaths, opts.backend]
+    content = json.dumps([options, stats])
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+# Results of previous runs, stored with the fingerprint of their repository
+class ResultCache:
+    # Files modified less than this many seconds before a check may change
+    # again within the mtime granularity, their repository is not cached
+    racyDelay = 2
+
+    def __init__(self, opts):
+        self.filename = os.path.join(getCacheDir(), 'results.json')
+        self.entries = {}
+        self.hits = 0
+
+    def load(self):
+        self.entries = loadCacheFile(self.filename) or {}
+
+    def save(self):
+        saveCacheFile(self.filename, self.entries)
+
+    def get(self, rep, fingerprint):
+        entry = self.entries.get(rep)
+        if fingerprint is None or entry is None or entry['fingerprint'] != fingerprint:
+            return None
+        self.hits += 1
+        return RepoResult.fromDict(entry['result'])
+
+    def put(self, rep, fingerprint, result):
+        self.entries[rep] = {'fingerprint': fingerprint, 'result': result.toDict()}
+
+
+# Untracked cache and builtin fsmonitor of the checked repositories. With
+# --accelerate check the repositories without them are shown in debug mode,
+# with --accelerate enable they are configured and recorded in
+# accelerated.json. The configuration is read again on every run, so
+# settings unset since they were recorded are reported (or enabled) again
+class Accelerator:
+    def __init__(self, opts):
+        self.enable = opts.accelerate == 'enable'
+        self.jobs = opts.jobs
+        self.filename = os.path.join(getCacheDir(), 'accelerated.json')
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.settings = None
+        self.candidates = 0
+
+    def load(self):
+        self.entries = loadCacheFile(self.filename) or {}
+
+    def save(self):
+        saveCacheFile(self.filename, self.entries)
+
+    # The builtin fsmonitor daemon is not available on every platform
+    def getSettings(self):
+        if self.settings is None:
+            self.settings = ['core.untrackedcache']
+            if 'fsmonitor--daemon' in gitExec(os.getcwd(), "version --build-options"):
+                self.settings.append('core.fsmonitor')
+        return self.settings
+
+    # Settings missing in the repository configuration
+    def getMissing(self, rep):
+        config = {}
+        for line in gitExec(rep, "config --list").splitlines():
+            key, _, value = line.partition('=')
+            config[key.lower()] = value.lower()
+        missing = []
+        for key in self.getSettings():
+            if config.get(key, 'false') in ('false', 'no', 'off', '0', '', 'keep'):
+                missing.append(key)
+        return missing
+
+    def timeStatus(self, rep):
+        start = time.time()
+        gitExec(rep, "status --porcelain -z")
+        return time.time() - start
+
+    def accelerate(self, rep):
+        missing = self.getMissing(rep)
+        if not missing:
+            return
+        if not self.enable:
+            if rep in self.entries:
+                showDebug("  %s: %s unset since enabled on %s" % (
+                    rep, ', '.join(missing), self.entries[rep]['timestamp']))
+            else:
+                showDebug("  %s: %s not enabled" % (rep, ', '.join(missing)))
+            with self.lock:
+                self.candidates += 1
+            return
+
+        before = self.timeStatus(rep)
+        for key in missing:
+            gitExec(rep, "config %s true" % key)
+        # The first status fills the untracked cache and starts the fsmonitor daemon
+        self.timeStatus(rep)
+        after = self.timeStatus(rep)
+        showDebug("  %s: enabled %s, status %.3fs -> %.3fs (%.1fx)" % (
+            rep, ', '.join(missing), before, after, before / max(after, 0.001)))
+        with self.lock:
+            self.entries[rep] = {
+                'settings': missing,
+                'timestamp': strftime("%Y-%m-%d %H:%M:%S"),
+                'before': before,
+                'after': after,
+            }
+
+    def run(self, repo):
+        from concurrent.futures import ThreadPoolExecutor
+        self.load()
+        with ThreadPoolExecutor(max_workers=max(self.jobs, 1)) as pool:
+            list(pool.map(self.accelerate, repo))
+        self.finish()
+
+    # Accelerate the repositories while they are found, for --pipeline
+    def each(self, repos):
+        self.load()
+        for r in repos:
+            self.accelerate(r)
+            yield r
+        self.finish()
+
+    def finish(self):
+        if self.enable:
+            self.save()
+        elif self.candidates:
+            print("%s repositories without untracked cache or fsmonitor, see --accelerate enable"
+                  % self.candidates, file=sys.stderr)
+
+
+# Check durations of the previous runs, the longest checks are started first
+# so a few slow repositories don't end the run alone
+class TimingCache:
+    def __init__(self):
+        self.filename = os.path.join(getCacheDir(), 'timings.json')
+        self.entries = {}
+
+    def load(self):
+        self.entries = loadCacheFile(self.filename) or {}
+
+    def save(self, durations):
+        self.entries.update(durations)
+        saveCacheFile(self.filename, self.entries)
+
+    # Longest expected first, never checked repositories before the others
+    def schedule(self, repo):
+        return sorted(repo, key=lambda r: (r in self.entries, -self.entries.get(r, 0)))
+
+    # Run time of the checks on jobs workers, in the schedule order
+    def predictMakespan(self, repo, jobs):
+        workers = [0.0] * max(jobs, 1)
+        for r in self.schedule(repo):
+            heapq.heapreplace(workers, workers[0] + self.entries.get(r, 0))
+        return max(workers)
+
+
+# Check repositories with a pool of opts.jobs workers, yield results in repo
+# order, or as they complete when ordered is False. With a fetch scheduler,
+# each check starts once its fetches are done. With timings, the checks
+# expected to be the longest are started first
+def checkRepositories(repo, opts, args, fetcher=None, cache=None, ordered=True, timings=None):
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    if fetcher is None and (opts.jobs <= 1 or len(repo) <= 1):
+        for r in repo:
+            yield checkRepositoryBranches(r, opts, args, cache)
+        return
+
+    showDebug("Checking with %s workers" % opts.jobs)
+    scheduled = repo
+    if timings is not None and fetcher is None:
+        scheduled = timings.schedule(repo)
+        showDebug("Predicted checks makespan %.3fs, %s repositories without timings" % (
+            timings.predictMakespan(repo, opts.jobs), len([r for r in repo if r not in timings.entries])))
+    with ThreadPoolExecutor(max_workers=max(opts.jobs, 1)) as pool:
+        futures = {}
+        for r in scheduled:
+            if fetcher is None:
+                futures[r] = pool.submit(checkRepositoryBranches, r, opts, args, cache)
+            else:
+                futures[r] = fetcher.then(r, pool, checkRepositoryBranches, r, opts, args, cache)
+        if ordered:
+            pending = [futures[r] for r in repo]
+        else:
+            pending = as_completed(futures.values())
+        for f in pending:
+            yield f.result()
+
+
+# Check repositories while they are found, with at most opts.jobs * 4 of
+# them in progress, the walk waits for the oldest one beyond that. Results
+# are yielded in discovery order
+def checkDiscovered(discovered, opts, args, fetcher=None, cache=None):
+    from concurrent.futures import ThreadPoolExecutor
+    window = max(opts.jobs, 1) * 4
+    inprogress = deque()
+    with ThreadPoolExecutor(max_workers=max(opts.jobs, 1)) as pool:
+        for r in discovered:
+            if fetcher is None:
+                inprogress.append(pool.submit(checkRepositoryBranches, r, opts, args, cache))
+            else:
+                if opts.format == 'text':
+                    print("Updating %s remotes..." % r)
+                fetcher.schedule(r)
+                inprogress.append(fetcher.then(r, pool, checkRepositoryBranches, r, opts, args, cache))
+            if len(inprogress) >= window:
+                yield inprogress.popleft().result()
+        while inprogress:
+            yield inprogress.popleft().result()
+
+
+# Print a result as soon as it is checked, for the streamed formats
+def printResult(result):
+    if opts.format == 'text' and not opts.email:
+        lines = renderTerminal(result)
+    elif opts.format == 'jsonl':
+        lines = renderJsonLines(result)
+    else:
+        return
+    for line in lines:
+        print(line, flush=opts.format == 'jsonl')
+
+
+# Check all git repositories and return a Report. When the report of a
+# previous run is given, only the changed repositories are checked again
+# and the other results are reused
+def gitcheck(args, previous=None, changed=()):
     if opts.debugmod:
         showDebug("Global Vars:")
         for k, v in opts.__dict__.items():
             showDebug("\t%s: %s" %(k, v))
 
-    repo = searchRepositories(args)
-    actionNeeded = False
-
-    if opts.checkremote:
-        for r in repo:
-            print ("Updating %s remotes..." % r)
-            updateRemote(r)
-
-    if opts.watchInterval > 0:
-        print(colortheme['reset'])
+    gitstats.commands.clear()
+    gitstats.durations.clear()
+    limits.deadline = time.time() + opts.deadline if opts.deadline else None
+    del profiler.events[:]
+    report = Report(args[-1] if args else "")
+    pipeline = opts.pipeline and previous is None
+    if pipeline:
+        # Repositories are checked while the tree is walked
+        repo = tocheck = None
+    elif previous is None:
+        with profilePhase('discovery'):
+            repo = searchRepositories(args)
+        tocheck = repo
+    else:
+        reused = dict((r.path, r) for r in previous.repositories)
+        repo = sorted(reused)
+        tocheck = [r for r in repo if r in changed]
+
+    fetcher = None
+    if opts.checkremote and previous is None:
+        fetcher = FetchScheduler(opts)
+        for r in repo or []:
+            if opts.format == 'text':
+                print ("Updating %s remotes..." % r)
+            fetcher.schedule(r)
+        showDebug("Scheduled %s fetches for %s repositories" % (fetcher.total, len(repo or [])))
+
+    if opts.watchInterval > 0 and opts.format == 'text':
+        print(getColorTheme()['reset'])
         print(strftime("%Y-%m-%d %H:%M:%S"))
 
     showDebug("Processing repositories... please wait.")
-    for r in repo:
-        if opts.checkall:
-            branch = getAllBranches(r)
+    cache = None
+    if opts.cache or opts.cacheDeep:
+        cache = ResultCache(opts)
+        if not opts.noCache:
+            cache.load()
+
+    if opts.accelerate and previous is None and not pipeline:
+        with profilePhase('accelerate'):
+            Accelerator(opts).run(repo)
+
+    timings = TimingCache()
+    timings.load()
+
+    checkstart = time.time()
+    with profilePhase('check'):
+        if pipeline:
+            discovered = discoverRepositories(args)
+            if opts.accelerate:
+                discovered = Accelerator(opts).each(discovered)
+            results = checkDiscovered(discovered, opts, args, fetcher, cache)
+        elif opts.format == 'jsonl':
+            # Stream the results as they complete
+            results = chain((reused[r] for r in repo if r not in tocheck),
+                            checkRepositories(tocheck, opts, args, fetcher, cache, False, timings))
         else:
-            branch = getDefaultBranch(r)
-        for b in branch:
-            if checkRepository(r, b, opts, args):
-                actionNeeded = True
-    html.timestamp = strftime("%Y-%m-%d %H:%M:%S")
-    html.msg += "</ul>\n<p>Report created on %s</p>\n" % html.timestamp
+            checked = checkRepositories(tocheck, opts, args, fetcher, cache, timings=timings)
+            results = (next(checked) if r in tocheck else reused[r] for r in repo)
+
+        # With --pipeline --order sorted, results are printed once all are checked
+        deferred = pipeline and opts.order == 'sorted'
+        rendering = 0
+        for result in results:
+            report.repositories.append(result)
+            if not deferred:
+                start = time.time()
+                printResult(result)
+                rendering += time.time() - start
+        if not pipeline or opts.order == 'sorted':
+            report.repositories.sort(key=lambda r: r.path)
+        if deferred:
+            start = time.time()
+            for result in report.repositories:
+                printResult(result)
+            rendering += time.time() - start
+        if fetcher is not None:
+            fetcher.shutdown()
+            profileEvent('phase', 'fetch', fetcher.started, fetcher.finished - fetcher.started)
+    showDebug("Actual checks makespan %.3fs" % (time.time() - checkstart))
+    timings.save(gitstats.durations)
+    if cache is not None:
+        showDebug("Reused %s cached results" % cache.hits)
+        cache.save()
+    showDebug("Spawned %s git commands for %s repositories" % (
+        sum(gitstats.commands.values()), len(report.repositories if tocheck is None else tocheck)))
+    report.timestamp = strftime("%Y-%m-%d %H:%M:%S")
+
+    # Terminal output is rendered while checking, count it in the render phase
+    start = time.time()
+    if opts.format == 'json':
+        print(renderJson(report))
+    elif opts.format == 'jsonl':
+        print(renderJsonSummary(report), flush=True)
+    profileEvent('phase', 'render', start, time.time() - start + rendering)
+
+    if report.actionNeeded and opts.bellOnActionNeeded and opts.format == 'text':
+        print(getColorTheme()['bell'])
+
+    return report
+
+
+# Linux inotify through ctypes, watch the .git files that change the
+# result of a check (index, HEAD, refs, FETCH_HEAD) and the working trees
+class InotifyWatcher:
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    # Files of the git directory which change the result of a check, and
+    # those of the common directory shared by linked worktrees
+    gitfiles = ('index', 'HEAD', 'FETCH_HEAD', 'ORIG_HEAD', 'packed-refs', 'config')
+    commonfiles = ('FETCH_HEAD', 'packed-refs', 'config')
+
+    # Seconds without events before changed repositories are checked
+    debounce = 0.5
+
+    def __init__(self, rescan):
+        # Seconds between searches for added and removed repositories
+        self.rescan = rescan
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        # Watched directories may be shared by repositories (worktrees share
+        # the common directory, nested repositories the parent working tree)
+        # and inotify gives them a single descriptor, so several (rep, path,
+        # kind) entries per descriptor
+        self.watches = {}
+
+    def close(self):
+        os.close(self.fd)
+
+    def addWatch(self, path, rep, kind):
+        import ctypes
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "%s: %s" % (os.strerror(errno), path))
+        entries = self.watches.setdefault(wd, [])
+        if (rep, path, kind) not in entries:
+            entries.append((rep, path, kind))
+
+    def addTree(self, path, rep, kind):
+        for directory, dirnames, filenames in os.walk(path):
+            dirnames[:] = [d for d in dirnames if d != '.git']
+            self.addWatch(directory, rep, kind)
+
+    def addRepository(self, rep):
+        try:
+            gitdir, commondir = getGitDirs(rep)
+        except (UnsupportedLayout, EnvironmentError):
+            gitdir = commondir = os.path.join(rep, '.git')
+        self.addWatch(gitdir, rep, 'gitdir')
+        if commondir != gitdir:
+            self.addWatch(commondir, rep, 'commondir')
+        self.addTree(os.path.join(commondir, 'refs'), rep, 'refs')
+        self.addTree(rep, rep, 'worktree')
+
+    # Parse the pending events, return the changed repositories, or None when
+    # the kernel queue overflowed and all repositories must be checked
+    def readEvents(self):
+        import struct
+        changed = set()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b'\0'))
+            offset += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            if wd not in self.watches or name.endswith('.lock'):
+                continue
+            for rep, path, kind in list(self.watches[wd]):
+                if kind == 'gitdir' and name not in self.gitfiles:
+                    continue
+                if kind == 'commondir' and name not in self.commonfiles:
+                    continue
+                if kind == 'worktree' and name == '.git':
+                    continue
+                if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self.addTree(os.path.join(path, name), rep, kind)
+                changed.add(rep)
+
+        return changed
+
+    # Wait for changes, then until no event came for the debounce delay.
+    # Return the changed repositories, an empty set on timeout, or None on
+    # queue overflow
+    def wait(self, timeout=None):
+        import select
+        changed = set()
+        while True:
+            ready, _, _ = select.select([self.fd], [], [], self.debounce if changed else timeout)
+            if not ready:
+                return changed
+            events = self.readEvents()
+            if events is None:
+                return None
+            changed.update(events)
+
+
+# Watch repositories with inotify, return None when it is not available
+# Poll the repositories with stat() only, for file systems without inotify
+# (NFS, SSHFS). A repository is polled every interval seconds, doubled up
+# to ceiling while its .git files don't change and reset when they do.
+# Edits of the working tree alone don't change them, idle repositories are
+# checked again every ceiling seconds, and the tree is searched again for
+# added and removed repositories at the same interval
+class PollingWatcher:
+    def __init__(self, repo, interval, ceiling):
+        self.interval = interval
+        self.ceiling = max(ceiling, interval)
+        self.rescan = self.ceiling
+        now = time.time()
+        # Signature, polling interval and next poll time of each repository
+        self.repos = dict((r, [self.getSignature(r), interval, now + interval]) for r in repo)
+        self.reported = set()
+
+    def close(self):
+        pass
+
+    # Hash of the stats of the .git files changed by git commands and of the
+    # working tree top directory
+    def getSignature(self, rep):
+        try:
+            gitdir, commondir = getGitDirs(rep)
+        except (UnsupportedLayout, EnvironmentError):
+            gitdir = commondir = os.path.join(rep, '.git')
+        paths = [
+            rep,
+            os.path.join(gitdir, 'index'),
+            os.path.join(gitdir, 'HEAD'),
+            os.path.join(gitdir, 'logs', 'HEAD'),
+            os.path.join(commondir, 'packed-refs'),
+            os.path.join(commondir, 'FETCH_HEAD'),
+            os.path.join(commondir, 'config'),
+        ]
+        for top in ('heads', 'remotes'):
+            for directory, dirnames, filenames in os.walk(os.path.join(commondir, 'refs', top)):
+                paths.append(directory)
+                paths.extend(os.path.join(directory, f) for f in filenames)
+
+        stats = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                stats.append((path, st.st_mtime_ns, st.st_size))
+            except OSError:
+                stats.append((path, None))
+        return hash(tuple(stats))
+
+    # Return the repositories to check again, or an empty set on timeout
+    def wait(self, timeout=None):
+        end = None if timeout is None else time.time() + timeout
+        # Checks rewrite the index, take the signatures after them
+        for r in self.reported:
+            if r in self.repos:
+                self.repos[r][0] = self.getSignature(r)
+        self.reported = set()
+
+        while True:
+            now = time.time()
+            changed = set()
+            polled = 0
+            for r, state in list(self.repos.items()):
+                if state[2] > now:
+                    continue
+                polled += 1
+                # Removed repositories are reported once, then no more polled
+                if not os.path.lexists(os.path.join(r, '.git')):
+                    del self.repos[r]
+                    changed.add(r)
+                    continue
+                signature = self.getSignature(r)
+                if signature != state[0]:
+                    state[:] = [signature, self.interval, now + self.interval]
+                    changed.add(r)
+                    continue
+                if state[1] >= self.ceiling:
+                    changed.add(r)
+                state[1] = min(state[1] * 2, self.ceiling)
+                state[2] = now + state[1]
+            if polled:
+                showDebug("Polled %s of %s repositories, %s to check" % (polled, len(self.repos), len(changed)))
+            if changed:
+                self.reported = changed
+                return changed
+
+            nextpoll = min([state[2] for state in self.repos.values()] or [now + self.interval])
+            if end is not None and nextpoll >= end:
+                time.sleep(max(end - now, 0))
+                return set()
+            time.sleep(max(nextpoll - now, 0))
+
+
+def startWatcher(repo):
+    ceiling = opts.watchMax or opts.watchInterval * 16
+    if opts.watchBackend == 'adaptive':
+        showDebug("Polling %s repositories every %s to %s seconds" % (len(repo), opts.watchInterval, ceiling))
+        return PollingWatcher(repo, opts.watchInterval, ceiling)
+    if opts.watchBackend == 'poll' or not sys.platform.startswith('linux'):
+        return None
+    try:
+        watcher = InotifyWatcher(ceiling)
+    except (OSError, AttributeError) as e:
+        showDebug("inotify is not available (%s), polling every %s seconds" % (e, opts.watchInterval))
+        return None
+
+    try:
+        for r in repo:
+            watcher.addRepository(r)
+    except OSError as e:
+        print("Unable to watch repositories (%s), polling every %s seconds" % (e, opts.watchInterval), file=sys.stderr)
+        watcher.close()
+        return None
 
-    if actionNeeded and opts.bellOnActionNeeded:
-        print(colortheme['bell'])
+    showDebug("Watching %s repositories with %s inotify watches" % (len(repo), len(watcher.watches)))
+    return watcher
 
 
-def sendReport(content):
+def sendReport(report):
+    import json
     userPath = expanduser('~')
     #filepath = r'%s\Documents\.gitcheck' % userPath
     #filename = filepath + "//mail.properties"
@@ -401,16 +2222,20 @@ def sendReport(content):
         print(msg, file=sys.stderr)
         sys.exit(1)
 
+    import smtplib
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
     # Create message container - the correct MIME type is multipart/alternative.
     msg = MIMEMultipart('alternative')
-    msg['Subject'] = "Gitcheck Report (%s)" % (html.path)
+    msg['Subject'] = "Gitcheck Report (%s)" % (report.path)
     msg['From'] = config['from']
     msg['To'] = config['to']
 
     # Create the body of the message (a plain-text and an HTML version).
-    text = "Gitcheck report for %s created on %s\n\n This file can be seen in html only." % (html.path, html.timestamp)
+    text = "Gitcheck report for %s created on %s\n\n This file can be seen in html only." % (report.path, report.timestamp)
     htmlcontent = "<html>\n<head>\n<h1>Gitcheck Report</h1>\n<h2>%s</h2>\n</head>\n<body>\n<p>%s</p>\n</body>\n</html>" % (
-        html.path, content
+        report.path, renderHtml(report)
     )
     # Write html file to disk
     f = open(os.path.join(filepath, 'result.html'), 'w')
@@ -433,7 +2258,7 @@ def sendReport(content):
         # and message to send - here it is sent as one string.
         s.sendmail(config['from'], config['to'], msg.as_string())
         s.quit()
-    except SMTPException as e:
+    except smtplib.SMTPException as e:
         print("Error sending email : %s" % str(e))
 
 def bkupMailConfig(src, suffix='old'):
@@ -445,7 +2270,7 @@ def bkupMailConfig(src, suffix='old'):
         sys.exit(1)
 
 def initEmailConfig():
-
+    import json
     config = {
         'smtp': 'yourserver',
         'smtp_port': 25,
@@ -480,25 +2305,321 @@ def readDefaultConfig():
     if os.path.exists(filename):
         pass
 
-def main(args):
+# Run gitcheck and yield the report, in watch mode run it again each time
+# repositories change (or every opts.watchInterval seconds when polling).
+# The tree is searched again every watcher.rescan seconds, added or removed
+# repositories trigger a full run
+def runReports(args):
+    report = None
+    changed = ()
+    watcher = None
     while True:
         try:
-            gitcheck(args)
+            report = gitcheck(args, report, changed)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception as e:
+            print ("Unexpected error:", str(e))
+        else:
+            yield report
+
+        if opts.watchInterval <= 0:
+            break
 
+        if watcher is None and report is not None:
+            watcher = startWatcher([r.path for r in report.repositories])
+        if watcher is None:
+            time.sleep(opts.watchInterval)
+            report = None
+            continue
+        if not changed:
+            rescan = time.time() + (opts.watchInterval if opts.checkremote else watcher.rescan)
+
+        # The remote update needs a periodic full run, otherwise a full run
+        # only happens when repositories were added or removed
+        while True:
+            changed = watcher.wait(max(rescan - time.time(), 0))
+            if changed is None:
+                break
+            if changed:
+                if any(not os.path.exists(os.path.join(r, '.git')) for r in changed):
+                    changed = None
+                break
+            if opts.checkremote or searchRepositories(args) != sorted(r.path for r in report.repositories):
+                changed = None
+                break
+            rescan = time.time() + watcher.rescan
+        if changed is None:
+            watcher.close()
+            watcher = None
+            report = None
+
+
+def main(args):
+    loadUserConfig()
+    if opts.daemon:
+        serveDaemon(args)
+        return
+
+    for report in runReports(args):
+        try:
             if opts.email:
-                sendReport(html.msg)
+                with profilePhase('email'):
+                    sendReport(report)
+
+            if opts.profile:
+                showProfile()
+                if opts.trace:
+                    writeTrace(opts.trace)
 
         except (KeyboardInterrupt, SystemExit):
             raise
         except Exception as e:
-            print ("Unexpected error:", str(e))
+            print("Unexpected error:", str(e))
+
+
+# Default path of the daemon socket
+def getSocketPath():
+    rundir = os.environ.get('XDG_RUNTIME_DIR') or getCacheDir()
+    return os.path.join(rundir, 'gitcheck.sock')
+
+
+# Answer a daemon query from the latest report, queries are
+# {"query": "report"}, {"query": "repository", "path": <path>} for the
+# repository containing path, and {"query": "action"} for the repositories
+# with local changes or commits to push or pull
+def answerQuery(report, request):
+    query = request.get('query', 'report')
+    if not isinstance(query, str) or not isinstance(request.get('path', ''), str):
+        return {'error': 'invalid request: query and path must be strings'}
+    if query == 'report':
+        repositories = report.repositories
+    elif query == 'repository':
+        path = os.path.abspath(request.get('path', ''))
+        matches = [r for r in report.repositories
+                   if path == r.path or path.startswith(r.path.rstrip(os.sep) + os.sep)]
+        repositories = sorted(matches, key=lambda r: len(r.path))[-1:]
+    elif query == 'action':
+        repositories = [r for r in report.repositories if any(b.ischange for b in r.branches)]
+    else:
+        return {'error': 'unknown query %s' % query}
+
+    answer = report.toDict()
+    answer['repositories'] = [r.toDict() for r in repositories]
+    return answer
+
+
+# Keep the report in memory, refreshed in the background like --watch, and
+# answer JSON queries on a Unix domain socket, one request line per connection
+def serveDaemon(args):
+    import json
+    import socketserver
+
+    # The daemon only answers queries, nothing is printed on each run
+    opts.format = None
+    opts.watchInterval = opts.watchInterval or 60
+    reports = runReports(args)
+    state = {'report': next(reports)}
+
+    def refresh():
+        for report in reports:
+            state['report'] = report
+
+    class QueryHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline().decode('utf-8') or '{}')
+                if not isinstance(request, dict):
+                    raise ValueError("not a JSON object")
+                answer = answerQuery(state['report'], request)
+            except (ValueError, TypeError) as e:
+                answer = {'error': 'invalid request: %s' % e}
+            self.wfile.write(json.dumps(answer).encode('utf-8') + b'\n')
+
+    socketpath = opts.socket or getSocketPath()
+    if os.path.exists(socketpath):
+        os.unlink(socketpath)
+    if not os.path.isdir(os.path.dirname(socketpath)):
+        os.makedirs(os.path.dirname(socketpath))
+    # Only the user can query the daemon
+    umask = os.umask(0o077)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(socketpath, QueryHandler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=refresh, name='refresh')
+    thread.daemon = True
+    thread.start()
+    showDebug("Serving %s repositories on %s" % (len(state['report'].repositories), socketpath))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(socketpath)
+
+
+# Query a running daemon, 'gitcheck client [report|action|repository [<path>]]'
+def client(argv):
+    global opts
+    import json
+    parser = argparse.ArgumentParser(prog='gitcheck client',
+                                     description='Query a gitcheck daemon started with --daemon.')
+    parser.add_argument('query',
+                        nargs='?',
+                        choices=['report', 'action', 'repository'],
+                        default='report',
+                        help='Whole report, repositories needing action, or the repository containing <path>')
+    parser.add_argument('path',
+                        nargs='?',
+                        default='.',
+                        help='With repository, a path in the repository (default: current directory)')
+    parser.add_argument('--socket',
+                        metavar='<path>',
+                        help='Daemon socket (default: $XDG_RUNTIME_DIR/gitcheck.sock)')
+    parser.add_argument('--format',
+                        choices=['text', 'json'],
+                        default='json',
+                        help='Output format (default: json)')
+    parser.add_argument('--no-color',
+                        action='store_true',
+                        default=False,
+                        help='Disable colored output')
+    copts = parser.parse_args(argv)
 
-        if opts.watchInterval > 0:
-            time.sleep(opts.watchInterval)
-        else:
-            break
+    import socket
+    request = {'query': copts.query, 'path': os.path.abspath(copts.path)}
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(copts.socket or getSocketPath())
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        answer = sock.makefile('rb').read().decode('utf-8')
+    except OSError as e:
+        print("Unable to query the gitcheck daemon: %s" % e, file=sys.stderr)
+        return 1
+    finally:
+        sock.close()
+
+    if copts.format == 'json':
+        sys.stdout.write(answer)
+        return 0
+
+    content = json.loads(answer)
+    if 'error' in content:
+        print(content['error'], file=sys.stderr)
+        return 1
+    opts = parseArgs(['--verbose'])
+    if copts.no_color:
+        disableColors()
+    for result in Report.fromDict(content).repositories:
+        for line in renderTerminal(result):
+            print(line)
+    return 0
+
+
+# Read a report written with --format json or --format jsonl
+def readReport(filename):
+    import json
+    with open(filename) as fh:
+        content = fh.read()
+    # A json report is one object spread over lines, jsonl records have a
+    # type, a jsonl file may hold the summary record only
+    try:
+        record = json.loads(content)
+    except ValueError:
+        record = None
+    if isinstance(record, dict) and 'type' not in record:
+        return Report.fromDict(record)
+
+    # One record per line, branches are grouped back by repository
+    report = None
+    results = {}
+    for line in content.splitlines():
+        record = json.loads(line)
+        if record['type'] == 'summary':
+            report = Report(record['path'])
+            report.timestamp = record['timestamp']
+        elif record['type'] in ('branch', 'timeout'):
+            if record['path'] not in results:
+                results[record['path']] = RepoResult(record['path'], record['repository'])
+            if record['type'] == 'timeout':
+                results[record['path']].timedout = True
+            else:
+                results[record['path']].branches.append(BranchResult.fromDict(record['branch']))
+    if report is None:
+        raise ValueError("no summary record")
+    report.repositories = list(results.values())
+    return report
+
+
+# Merge the json reports of --shard runs, 'gitcheck merge <file>...'
+def merge(argv):
+    global opts
+    parser = argparse.ArgumentParser(prog='gitcheck merge',
+                                     description='Merge reports written by gitcheck --format json or jsonl, '
+                                                 'for instance by --shard runs.')
+    parser.add_argument('files',
+                        nargs='+',
+                        metavar='<file>',
+                        help='Report files')
+    parser.add_argument('-v', '--verbose',
+                        action='store_true',
+                        default=False,
+                        help='Show files & commits')
+    parser.add_argument('-q', '--quiet',
+                        action='store_true',
+                        default=False,
+                        help='Display info only when repository needs action')
+    parser.add_argument('-e', '--email',
+                        action='store_true',
+                        default=False,
+                        help='Send an email with the merged report as html, using mail.properties parameters')
+    parser.add_argument('--format',
+                        choices=['text', 'json'],
+                        default='text',
+                        help='Output format (default: text)')
+    parser.add_argument('--no-color',
+                        action='store_true',
+                        default=False,
+                        help='Disable colored output')
+    mopts = parser.parse_args(argv)
+    opts = parseArgs([o for o, v in (('-v', mopts.verbose), ('-q', mopts.quiet)) if v])
+    if mopts.no_color:
+        disableColors()
+    loadUserConfig()
+
+    reports = []
+    for filename in mopts.files:
+        try:
+            reports.append(readReport(filename))
+        except (EnvironmentError, ValueError, KeyError, TypeError) as e:
+            print("Unable to load %s: %s" % (filename, e), file=sys.stderr)
+            return 1
+
+    paths = [r.path for r in reports]
+    report = Report(paths[0] if len(set(paths)) == 1 else os.path.commonpath(paths))
+    report.timestamp = max(r.timestamp for r in reports)
+    results = dict((result.path, result) for r in reports for result in r.repositories)
+    report.repositories = [results[path] for path in sorted(results)]
+
+    if mopts.format == 'json':
+        print(renderJson(report))
+    elif not mopts.email:
+        for result in report.repositories:
+            for line in renderTerminal(result):
+                print(line)
+    if mopts.email:
+        try:
+            sendReport(report)
+        except Exception as e:
+            print("Unexpected error:", str(e))
+            return 1
+    return 0
 
-if __name__ == "__main__":
+
+# Parse the command line options
+def parseArgs(argv):
     parser = argparse.ArgumentParser(description='Check multiple git repository in one pass.',
                                      epilog='example: gitcheck -m 1 -q target'
                                      )
@@ -506,16 +2627,74 @@ if __name__ == "__main__":
                         action='store_true',
                         default=False,
                         help='Show files & commits')
+    parser.add_argument('--max-commits',
+                        dest='maxCommits',
+                        metavar='<n>',
+                        action='store',
+                        type=int,
+                        default=20,
+                        help='In verbose mode, show at most <n> commits to push or pull per remote, 0 for all (default: 20)')
     parser.add_argument('--debug',
                         dest='debugmod',
                         action='store_true',
                         default=False,
                         help='Show debug message')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        default=False,
+                        help='Time every git command, repository and phase, and print the slowest ones')
+    parser.add_argument('--profile-top',
+                        dest='profileTop',
+                        metavar='<n>',
+                        action='store',
+                        type=int,
+                        default=10,
+                        help='With --profile, show the <n> slowest repositories and commands (default: 10)')
+    parser.add_argument('--trace',
+                        metavar='<file>',
+                        action='store',
+                        help='Write a Chrome trace event file of the run (implies --profile), '
+                             'open it with chrome://tracing or https://ui.perfetto.dev')
     parser.add_argument('-r', '--remote',
                         dest='checkremote',
                         action='store_true',
                         default=False,
                         help='Force remote update (slow)')
+    parser.add_argument('--fetch-jobs',
+                        dest='fetchJobs',
+                        metavar='<n>',
+                        action='store',
+                        type=int,
+                        default=8,
+                        help='With --remote, run at most <n> fetches at a time (default: 8)')
+    parser.add_argument('--fetch-host-jobs',
+                        dest='fetchHostJobs',
+                        metavar='<n>',
+                        action='store',
+                        type=int,
+                        default=4,
+                        help='With --remote, run at most <n> fetches at a time to the same host (default: 4)')
+    parser.add_argument('--timeout',
+                        metavar='<sec>',
+                        action='store',
+                        type=float,
+                        default=0,
+                        help='Kill git commands running longer than <sec> seconds, their repository is shown '
+                             'as timed out (default: no timeout, fetches use --fetch-timeout)')
+    parser.add_argument('--deadline',
+                        metavar='<sec>',
+                        action='store',
+                        type=float,
+                        default=0,
+                        help='Stop checking after <sec> seconds, repositories not checked by then are shown '
+                             'as timed out (default: no deadline)')
+    parser.add_argument('--fetch-timeout',
+                        dest='fetchTimeout',
+                        metavar='<sec>',
+                        action='store',
+                        type=float,
+                        default=0,
+                        help='With --remote, abort a fetch after <sec> seconds (default: no timeout)')
     parser.add_argument('-u', '--untracked',
                         dest='checkUntracked',
                         action='store_true',
@@ -533,6 +2712,56 @@ if __name__ == "__main__":
                         type=float,
                         default=0,
                         help='After displaying, wait <sec> and run again')
+    parser.add_argument('--watch-backend',
+                        dest='watchBackend',
+                        choices=['inotify', 'poll', 'adaptive'],
+                        default='inotify',
+                        help='With --watch, check again only the repositories changed on disk (inotify, '
+                             'Linux only, the default), everything every <sec> (poll), or the repositories '
+                             'whose .git files changed, polling idle ones less often (adaptive, for network '
+                             'file systems)')
+    parser.add_argument('--watch-max',
+                        dest='watchMax',
+                        metavar='<sec>',
+                        action='store',
+                        type=float,
+                        default=0,
+                        help='With --watch-backend adaptive, longest polling interval of idle repositories, '
+                             'with inotify and adaptive, interval of the search for added or removed '
+                             'repositories (default: 16 times the --watch interval)')
+    parser.add_argument('-c', '--cache',
+                        action='store_true',
+                        default=False,
+                        help='Reuse the previous result of repositories whose index, HEAD and refs did not change '
+                             '(edits of the working tree alone are not noticed, see --cache-deep)')
+    parser.add_argument('--cache-deep',
+                        dest='cacheDeep',
+                        action='store_true',
+                        default=False,
+                        help='Like --cache, also compare the working tree files')
+    parser.add_argument('--no-cache',
+                        dest='noCache',
+                        action='store_true',
+                        default=False,
+                        help='Ignore cached results, check every repository and refresh the cache')
+    parser.add_argument('--accelerate',
+                        choices=['check', 'enable'],
+                        help='Check (or enable) core.untrackedCache and the builtin fsmonitor of the repositories, '
+                             'for faster local changes and --untracked checks')
+    parser.add_argument('--backend',
+                        choices=['subprocess', 'pygit2'],
+                        default='subprocess',
+                        help='Read the repositories by running git (subprocess, the default) or in-process '
+                             'with libgit2 (pygit2, needs the pygit2 module)')
+    parser.add_argument('--daemon',
+                        action='store_true',
+                        default=False,
+                        help="Keep results in memory, refreshed like --watch (default: every 60 seconds), "
+                             "and answer 'gitcheck client' queries on a Unix socket")
+    parser.add_argument('--socket',
+                        metavar='<path>',
+                        action='store',
+                        help='Socket of --daemon (default: $XDG_RUNTIME_DIR/gitcheck.sock)')
     parser.add_argument('-i', '--ignore-branch',
                         dest='ignoreBranch',
                         metavar='<re>',
@@ -546,6 +2775,35 @@ if __name__ == "__main__":
                         type=int,
                         default=0,
                         help='Limit to <depth> the repositories search')
+    parser.add_argument('-s', '--stop-at-repo',
+                        dest='stopAtRepo',
+                        action='store_true',
+                        default=False,
+                        help='Do not search for repositories inside a repository working tree')
+    parser.add_argument('-x', '--exclude',
+                        dest='excludeDirs',
+                        metavar='<glob>',
+                        action='append',
+                        default=[],
+                        help='Do not search directories matching <glob>, by name or relative path (repeatable)')
+    parser.add_argument('--shard',
+                        metavar='<i/N>',
+                        type=parseShard,
+                        help='Only check the i-th of N parts of the repositories, '
+                             'merge the --format json reports with gitcheck merge')
+    parser.add_argument('--pipeline',
+                        action='store_true',
+                        default=False,
+                        help='Check repositories while the tree is searched, at most 4 per job at a time')
+    parser.add_argument('--order',
+                        choices=['sorted', 'discovery'],
+                        default='sorted',
+                        help='With --pipeline, show results sorted once all repositories are checked, '
+                             'or in the order they are found (default: sorted)')
+    parser.add_argument('--rescan',
+                        action='store_true',
+                        default=False,
+                        help='Ignore the cached repository search and walk the whole tree')
     parser.add_argument('-q', '--quiet',
                         action='store_true',
                         default=False,
@@ -565,6 +2823,19 @@ if __name__ == "__main__":
                         action='store',
                         default=r'^$',
                         help='ignore changes in local files which match the regex <re>')
+    parser.add_argument('--ignore-path',
+                        dest='ignorePaths',
+                        metavar='<glob>',
+                        action='append',
+                        default=[],
+                        help='Ignore local changes in paths matching <glob>, git does not scan them (repeatable, '
+                             'also read from the .gitcheckignore file of each repository)')
+    parser.add_argument('--format',
+                        choices=['text', 'json', 'jsonl'],
+                        default='text',
+                        help='Output format, json prints the whole report once all repositories are checked, '
+                             'jsonl prints one line per branch as soon as its repository is checked '
+                             'and a summary line')
     parser.add_argument('--init-email',
                         action='store_true',
                         default=False,
@@ -577,15 +2848,35 @@ if __name__ == "__main__":
                         action='store_true',
                         default=False,
                         help='Disable colored output')
+    parser.add_argument('-j', '--jobs',
+                        metavar='<n>',
+                        action='store',
+                        type=int,
+                        default=os.cpu_count() or 1,
+                        help='Check <n> repositories in parallel (default: number of CPUs)')
     parser.add_argument('args',
                         nargs='*',
                         help='tree or directory to check')
 
-    opts = parser.parse_args(sys.argv[1:])
+    opts = parser.parse_args(argv)
+    opts.profile = opts.profile or bool(opts.trace)
+    if opts.backend == 'pygit2':
+        try:
+            import pygit2
+        except ImportError:
+            parser.error("--backend pygit2 needs the pygit2 module")
+    return opts
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['client']:
+        sys.exit(client(sys.argv[2:]))
+    if sys.argv[1:2] == ['merge']:
+        sys.exit(merge(sys.argv[2:]))
+    opts = parseArgs(sys.argv[1:])
     args = [os.path.abspath(e) for e in opts.args]
     if opts.no_color:
-        for k in colortheme:
-            colortheme[k]=''
+        disableColors()
     if opts.init_email:
         initEmailConfig()
     try:
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 __authors__ = 'Bruno Adelé <bruno@adele.im>'
@@ -8,8 +8,12 @@ __license__ = 'GPLv3'
 
 import os
 import sys
+import time
 import shutil
-from cStringIO import StringIO
+import tempfile
+import subprocess
+from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
 
 import unittest
 import git
@@ -18,12 +22,16 @@ from gitcheck import gitcheck
 
 GITROOT = '/tmp/gitcheck-unittest'
 
+# Import time budget of gitcheck.gitcheck once the standard modules it
+# needs are imported, in microseconds. It takes about 2.5ms from its
+# bytecode, an eager import of concurrent.futures or of the mail modules
+# alone exceeds the budget
+IMPORT_BUDGET = 8000
 
-def setUpModule():
-    # Get projects
-    get_github_projects("gitcheck", "https://github.com/badele/gitcheck.git")
-    get_github_projects("serialkiller", "https://github.com/badele/serialkiller.git")
-    get_github_projects("fabrecipes", "https://github.com/badele/fabrecipes.git")
+# Standard modules imported by gitcheck.gitcheck, their import time depends
+# on the interpreter and the machine, not on gitcheck
+STDLIB_MODULES = 'os, re, fnmatch, hashlib, argparse, time, subprocess, threading, heapq, signal, ' \
+                 'collections, itertools, shlex, contextlib'
 
 
 def get_github_projects(projectname, projecturl):
@@ -36,11 +44,18 @@ def get_github_projects(projectname, projecturl):
     os.chdir(GITROOT)
 
     # Get a git projects
-    print "Get git %s project" % projectname
+    print("Get git %s project" % projectname)
     git.Git().clone(projecturl)
 
 
 class TestPackages(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Get projects
+        get_github_projects("gitcheck", "https://github.com/badele/gitcheck.git")
+        get_github_projects("serialkiller", "https://github.com/badele/serialkiller.git")
+        get_github_projects("fabrecipes", "https://github.com/badele/fabrecipes.git")
+
     def setUp(self):
         # Redirect stdout
         self.output = StringIO()
@@ -91,5 +106,245 @@ class TestPackages(unittest.TestCase):
         self.assertEqual(lines[1], 'gitcheck/master ')
         self.assertEqual(lines[2], 'serialkiller/master')
 
+
+def run_git(cwd, *args):
+    subprocess.check_call(['git', '-C', cwd] + list(args), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+class TestFetchScheduler(unittest.TestCase):
+    # Seconds upload-pack waits before serving a fetch
+    delay = 0.3
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gitcheck-fetch-')
+        seed = os.path.join(self.root, 'seed')
+        run_git(self.root, 'init', '-q', seed)
+        run_git(seed, '-c', 'user.name=test', '-c', 'user.email=test@localhost',
+                'commit', '-q', '--allow-empty', '-m', 'Seed')
+        self.upstream = os.path.join(self.root, 'upstream.git')
+        run_git(self.root, 'clone', '-q', '--bare', seed, self.upstream)
+        self.slow = self.script('slow-upload-pack', self.delay)
+        self.hang = self.script('hang-upload-pack', 30)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def script(self, name, delay):
+        filename = os.path.join(self.root, name)
+        with open(filename, 'w') as fh:
+            fh.write('#!/bin/sh\nsleep %s\nexec git-upload-pack "$@"\n' % delay)
+        os.chmod(filename, 0o755)
+        return filename
+
+    # Clone the upstream repository over file://, fetches run uploadpack
+    def clone(self, name, uploadpack=None):
+        work = os.path.join(self.root, name)
+        run_git(self.root, 'clone', '-q', 'file://%s' % self.upstream, work)
+        run_git(work, 'config', 'remote.origin.uploadpack', uploadpack or self.slow)
+        return work
+
+    # Fetch the remotes of repos, and check each of them once its fetches are
+    # done. Return the checked repositories and the fetch commands run
+    def fetchAll(self, repos, *args):
+        gitcheck.opts = gitcheck.parseArgs(['--profile'] + list(args) + [self.root])
+        del gitcheck.profiler.events[:]
+        fetcher = gitcheck.FetchScheduler(gitcheck.opts)
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            for r in repos:
+                fetcher.schedule(r)
+            checks = [fetcher.then(r, pool, os.path.basename, r) for r in repos]
+            checked = [f.result(timeout=20) for f in checks]
+        fetcher.shutdown()
+        fetches = [e for e in gitcheck.profiler.events
+                   if e['cat'] == 'command' and e['name'].startswith('fetch ')]
+        return checked, fetches
+
+    # Largest number of fetches running at the same time
+    def concurrency(self, fetches):
+        return max(len([o for o in fetches if o['start'] <= e['start'] < o['start'] + o['duration']])
+                   for e in fetches)
+
+    def test_fetchOncePerObjectStore(self):
+        main = self.clone('main')
+        run_git(main, 'worktree', 'add', '-q', '-b', 'wt', os.path.join(self.root, 'main-wt'))
+        other = self.clone('other')
+        repos = [main, os.path.join(self.root, 'main-wt'), other]
+
+        checked, fetches = self.fetchAll(repos)
+        self.assertEqual(checked, ['main', 'main-wt', 'other'])
+        self.assertEqual(sorted(e['args']['repository'] for e in fetches), [main, other])
+        self.assertTrue(all(e['args']['returncode'] == 0 for e in fetches))
+
+    def test_failedFetch(self):
+        main = self.clone('main')
+        run_git(main, 'remote', 'set-url', 'origin', 'file://%s' % os.path.join(self.root, 'missing.git'))
+
+        checked, fetches = self.fetchAll([main])
+        self.assertEqual(checked, ['main'])
+        self.assertNotEqual(fetches[0]['args']['returncode'], 0)
+
+    def test_fetchTimeout(self):
+        main = self.clone('main', self.hang)
+        other = self.clone('other')
+
+        start = time.time()
+        checked, fetches = self.fetchAll([main, other], '--fetch-timeout', '1')
+        self.assertEqual(checked, ['main', 'other'])
+        self.assertLess(time.time() - start, 10)
+
+    def test_fetchHostJobs(self):
+        repos = [self.clone('repo-%d' % idx) for idx in range(4)]
+
+        # file:// remotes share the same empty host
+        start = time.time()
+        checked, fetches = self.fetchAll(repos, '--fetch-jobs', '4', '--fetch-host-jobs', '1')
+        self.assertEqual(len(fetches), 4)
+        self.assertEqual(self.concurrency(fetches), 1)
+        self.assertGreaterEqual(time.time() - start, 4 * self.delay)
+
+        checked, fetches = self.fetchAll(repos, '--fetch-jobs', '4', '--fetch-host-jobs', '2')
+        self.assertLessEqual(self.concurrency(fetches), 2)
+
+
+class TestRefReader(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gitcheck-refs-')
+        gitcheck.opts = gitcheck.parseArgs([self.root])
+        seed = os.path.join(self.root, 'seed')
+        run_git(self.root, 'init', '-q', '-b', 'master', seed)
+        self.commit(seed, 'Seed')
+        run_git(seed, 'branch', 'feature')
+        self.upstream = os.path.join(self.root, 'upstream.git')
+        run_git(self.root, 'clone', '-q', '--bare', seed, self.upstream)
+
+        self.main = os.path.join(self.root, 'main')
+        run_git(self.root, 'clone', '-q', 'file://%s' % self.upstream, self.main)
+        run_git(self.main, 'remote', 'set-head', 'origin', '-d')
+        run_git(self.main, 'branch', 'feature', 'origin/feature')
+        run_git(self.main, 'branch', 'topic/nested')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def commit(self, rep, message):
+        run_git(rep, '-c', 'user.name=test', '-c', 'user.email=test@localhost',
+                'commit', '-q', '--allow-empty', '-m', message)
+
+    def gitOutput(self, rep, *args):
+        return subprocess.check_output(['git', '-C', rep] + list(args)).decode('utf-8')
+
+    # {refname: sha} of the local and remote branches, as git reads them
+    def gitRefs(self, rep):
+        output = self.gitOutput(rep, 'for-each-ref', '--format=%(refname)%09%(objectname)', 'refs/heads', 'refs/remotes')
+        return dict(line.split('\t') for line in output.splitlines())
+
+    # Number of git commands run by gitcheck on rep
+    def commands(self, rep):
+        return gitcheck.gitstats.commands[rep]
+
+    def test_packedAndLooseRefs(self):
+        run_git(self.main, 'pack-refs', '--all')
+        self.assertFalse(os.path.exists(os.path.join(self.main, '.git', 'refs', 'heads', 'master')))
+        # A loose ref shadows its packed value
+        self.commit(self.main, 'Loose')
+        run_git(self.main, 'branch', 'loose')
+
+        before = self.commands(self.main)
+        self.assertEqual(gitcheck.getRefs(self.main), self.gitRefs(self.main))
+        self.assertEqual(gitcheck.getAllBranches(self.main), ['feature', 'loose', 'master', 'topic/nested'])
+        self.assertEqual(gitcheck.getDefaultBranch(self.main), {'master'})
+        self.assertEqual(gitcheck.getRemoteBranches(self.main), {'origin/feature', 'origin/master'})
+        self.assertEqual(gitcheck.getRemoteRepositories(self.main), ['origin'])
+        self.assertEqual(self.commands(self.main), before)
+
+    def test_linkedWorktree(self):
+        worktree = os.path.join(self.root, 'wt')
+        run_git(self.main, 'worktree', 'add', '-q', '-b', 'wt', worktree)
+        self.commit(worktree, 'Worktree')
+
+        gitdir, commondir = gitcheck.getGitDirs(worktree)
+        self.assertEqual(gitdir, os.path.join(self.main, '.git', 'worktrees', 'wt'))
+        self.assertEqual(commondir, os.path.join(self.main, '.git'))
+
+        before = self.commands(worktree)
+        self.assertEqual(gitcheck.getDefaultBranch(worktree), {'wt'})
+        self.assertEqual(gitcheck.getRefs(worktree), self.gitRefs(worktree))
+        self.assertEqual(gitcheck.getAllBranches(worktree), gitcheck.getAllBranches(self.main))
+        self.assertEqual(gitcheck.getRemoteRepositories(worktree), ['origin'])
+        self.assertEqual(self.commands(worktree), before)
+
+    def test_detachedHead(self):
+        run_git(self.main, 'checkout', '-q', '--detach')
+        current = [b[2:] for b in self.gitOutput(self.main, 'branch').splitlines() if b.startswith('* ')]
+
+        self.assertEqual(gitcheck.getDefaultBranch(self.main), set(current))
+        self.assertEqual(gitcheck.getAllBranches(self.main)[0], current[0])
+
+    def test_unbornBranch(self):
+        empty = os.path.join(self.root, 'empty')
+        run_git(self.root, 'init', '-q', '-b', 'master', empty)
+
+        self.assertEqual(gitcheck.getDefaultBranch(empty), {''})
+        self.assertEqual(gitcheck.getAllBranches(empty), [])
+        self.assertEqual(gitcheck.getRefs(empty), {})
+        self.assertEqual(self.commands(empty), 0)
+
+    def test_configInclude(self):
+        # Remotes of included files are only known to git
+        with open(os.path.join(self.root, 'included'), 'w') as fh:
+            fh.write('[remote "included"]\n\turl = file://%s\n' % self.upstream)
+        run_git(self.main, 'config', 'include.path', os.path.join(self.root, 'included'))
+
+        before = self.commands(self.main)
+        self.assertEqual(gitcheck.getRemoteRepositories(self.main), ['included', 'origin'])
+        self.assertEqual(self.commands(self.main), before + 1)
+
+    def test_reftable(self):
+        # Only detect the layout, git versions before 2.45 can't create it
+        os.makedirs(os.path.join(self.main, '.git', 'reftable'))
+        self.assertRaises(gitcheck.UnsupportedLayout, gitcheck.getGitDirs, self.main)
+
+        before = self.commands(self.main)
+        self.assertEqual(gitcheck.getRefs(self.main), self.gitRefs(self.main))
+        self.assertEqual(gitcheck.getAllBranches(self.main), ['feature', 'master', 'topic/nested'])
+        self.assertEqual(gitcheck.getDefaultBranch(self.main), {'master'})
+        self.assertEqual(self.commands(self.main), before + 3)
+
+
+class TestStartup(unittest.TestCase):
+    # Import gitcheck in a fresh interpreter, after the modules of preload,
+    # and return the cumulative import time of each module from the
+    # 'python -X importtime' report
+    def importTimes(self, preload=None):
+        code = 'import gitcheck.gitcheck'
+        if preload:
+            code = 'import %s; %s' % (preload, code)
+        cmd = [sys.executable, '-X', 'importtime', '-c', code]
+        # Time the import from the bytecode, not the compilation
+        env = dict(os.environ)
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, env=env,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        _, err = proc.communicate()
+        times = {}
+        for line in err.decode('utf-8').splitlines():
+            fields = line.split('|')
+            if line.startswith('import time:') and fields[1].strip().isdigit():
+                times[fields[2].strip()] = int(fields[1])
+        return times
+
+    @unittest.skipIf(sys.version_info < (3, 7), "-X importtime needs python 3.7")
+    def test_lazyImports(self):
+        times = self.importTimes()
+        for module in ('smtplib', 'email.mime.multipart', 'json', 'colored', 'concurrent.futures', 'logging'):
+            self.assertNotIn(module, times)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "-X importtime needs python 3.7")
+    def test_importTime(self):
+        # Only count what gitcheck adds to the standard modules it needs. Best
+        # of three runs, the first one may compile the module
+        best = min(self.importTimes(STDLIB_MODULES)['gitcheck.gitcheck'] for _ in range(3))
+        self.assertLess(best, IMPORT_BUDGET)
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)